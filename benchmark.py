@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+"""
+Офлайн-бенчмарк сервера на фейковом Telegram клиенте
+
+Поднимает main.py в отдельном процессе с FakeTelegramClient вместо Telethon,
+нагружает /telegram/channels/{category}, /photo/... и /ui на заданных уровнях
+параллельности и пишет throughput, p50/p95/p99 и пиковый RSS уровня (сервер
+вместе с дочерними процессами, например пулом Pillow) в JSON.
+
+    python benchmark.py --concurrency 1 8 32 --duration 10 --out bench_results.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+CATEGORIES = ["fashion", "beauty", "home"]
+
+
+def serve(args):
+    """Запуск сервера с фейковым клиентом (выполняется в дочернем процессе)"""
+    import uvicorn
+
+    import main
+    from fake_telegram import FakeTelegramClient
+
+    main.telegram_client.client = FakeTelegramClient(
+        latency=args.latency, jitter=args.latency / 2, flood_rate=args.flood_rate
+    )
+    main.telegram_client.set_connected(True)
+    uvicorn.run(main.app, host="127.0.0.1", port=args.port, log_level="warning")
+
+
+def percentile(sorted_values, fraction: float):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def tree_rss_mb(pid: int):
+    """Текущий RSS процесса и всех его потомков из /proc, в мегабайтах
+
+    VmHWM не годится: это пик за всю жизнь процесса, и в нем нет воркеров пула.
+    """
+    children = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                # comm может содержать пробелы - ppid идет вторым полем после закрывающей скобки
+                ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+
+    total_kb = 0
+    stack = [pid]
+    while stack:
+        current = stack.pop()
+        stack.extend(children.get(current, []))
+        try:
+            with open(f"/proc/{current}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total_kb += int(line.split()[1])
+                        break
+        except OSError:
+            pass
+    return round(total_kb / 1024, 1)
+
+
+async def sample_peak_rss(pid: int, peak: dict, interval: float = 0.1):
+    """Пишет в peak["mb"] максимум RSS дерева процессов, пока задачу не отменят"""
+    while True:
+        peak["mb"] = max(peak["mb"], tree_rss_mb(pid))
+        await asyncio.sleep(interval)
+
+
+def scenario_paths(scenario: str, photos):
+    """Бесконечный генератор путей запросов для сценария"""
+    i = 0
+    while True:
+        if scenario == "feed":
+            yield f"/telegram/channels/{CATEGORIES[i % len(CATEGORIES)]}"
+        elif scenario == "photo":
+            # Реальные фото из ленты по кругу: первый проход - промахи кэша, дальше - попадания
+            yield f"{photos[i % len(photos)]}?w=400&fmt=webp"
+        else:
+            yield "/ui"
+        i += 1
+
+
+async def run_level(base_url: str, scenario: str, concurrency: int, duration: float, photos, server_pid: int):
+    latencies = []
+    errors = 0
+    placeholders = 0
+    paths = scenario_paths(scenario, photos)
+    deadline = time.monotonic() + duration
+
+    async def worker(client):
+        nonlocal errors, placeholders
+        while time.monotonic() < deadline:
+            started = time.monotonic()
+            try:
+                response = await client.get(next(paths))
+                await response.aread()
+                if response.status_code >= 400:
+                    errors += 1
+                elif response.headers.get("content-type", "").startswith("image/svg+xml"):
+                    # Заглушка вместо фото - это не успешная отдача фото
+                    placeholders += 1
+            except httpx.HTTPError:
+                errors += 1
+            latencies.append((time.monotonic() - started) * 1000)
+
+    peak = {"mb": tree_rss_mb(server_pid)}
+    sampler = asyncio.create_task(sample_peak_rss(server_pid, peak))
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    try:
+        async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=60) as client:
+            started = time.monotonic()
+            await asyncio.gather(*(worker(client) for _ in range(concurrency)))
+            elapsed = time.monotonic() - started
+    finally:
+        sampler.cancel()
+
+    latencies.sort()
+    return {
+        "scenario": scenario,
+        "concurrency": concurrency,
+        "requests": len(latencies),
+        "errors": errors,
+        "placeholders": placeholders,
+        "peak_rss_mb": peak["mb"],
+        "throughput_rps": round(len(latencies) / elapsed, 1),
+        "latency_ms": {
+            "p50": round(percentile(latencies, 0.50), 2),
+            "p95": round(percentile(latencies, 0.95), 2),
+            "p99": round(percentile(latencies, 0.99), 2),
+            "max": round(latencies[-1], 2) if latencies else 0.0
+        }
+    }
+
+
+async def wait_ready(base_url: str, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient(base_url=base_url) as client:
+        while time.monotonic() < deadline:
+            try:
+                if (await client.get("/health/ready")).status_code == 200:
+                    return
+            except httpx.HTTPError:
+                pass
+            await asyncio.sleep(0.2)
+    raise RuntimeError("Server did not start")
+
+
+async def list_photos(base_url: str):
+    """Пути фото берем из ленты, чтобы запрашивать только посты, у которых фото есть"""
+    photos = []
+    async with httpx.AsyncClient(base_url=base_url, timeout=60) as client:
+        for category in CATEGORIES:
+            response = await client.get(f"/telegram/channels/{category}", params={"limit": 200})
+            photos.extend(post["media_url"] for post in response.json().get("posts", [])
+                          if post["media_url"].startswith("/photo/"))
+    if not photos:
+        raise RuntimeError("Feed has no posts with photos")
+    return photos
+
+
+async def benchmark(args, server_pid: int):
+    base_url = f"http://127.0.0.1:{args.port}"
+    await wait_ready(base_url)
+    photos = await list_photos(base_url) if "photo" in args.scenarios else []
+
+    results = []
+    for scenario in args.scenarios:
+        for concurrency in args.concurrency:
+            result = await run_level(base_url, scenario, concurrency, args.duration, photos, server_pid)
+            results.append(result)
+            print(f"📊 {scenario:5} c={concurrency:<4} {result['throughput_rps']:>8} rps  "
+                  f"p50={result['latency_ms']['p50']}ms p95={result['latency_ms']['p95']}ms "
+                  f"p99={result['latency_ms']['p99']}ms  rss={result['peak_rss_mb']}MB  "
+                  f"errors={result['errors']} placeholders={result['placeholders']}")
+    return results
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True).strip()
+    except Exception:
+        return None
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenarios", nargs="+", default=["feed", "photo", "ui"], choices=["feed", "photo", "ui"])
+    parser.add_argument("--concurrency", nargs="+", type=int, default=[1, 8, 32])
+    parser.add_argument("--duration", type=float, default=10, help="seconds per concurrency level")
+    parser.add_argument("--latency", type=float, default=0.05, help="fake Telegram RPC latency, seconds")
+    parser.add_argument("--flood-rate", type=float, default=0.0, help="probability of FloodWait per fake RPC")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--out", default="bench_results.json")
+    parser.add_argument("--serve", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args)
+        return
+
+    # Сервер пишет кэши и индекс во временный каталог, чтобы прогоны не влияли друг на друга
+    data_dir = tempfile.mkdtemp(prefix="bench-data-")
+    server = subprocess.Popen(
+        [sys.executable, __file__, "--serve", "--port", str(args.port),
+         "--latency", str(args.latency), "--flood-rate", str(args.flood_rate)],
+        env={**os.environ, "DATA_DIR": data_dir}
+    )
+    try:
+        results = asyncio.run(benchmark(args, server.pid))
+    finally:
+        server.terminate()
+        server.wait()
+
+    report = {
+        "revision": git_revision(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "host": {"python": platform.python_version(), "cpus": os.cpu_count(), "platform": platform.platform()},
+        "config": {
+            "duration": args.duration,
+            "latency": args.latency,
+            "flood_rate": args.flood_rate
+        },
+        "results": results
+    }
+    with open(args.out, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"✅ Results written to {args.out}")
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,37 @@
+"""
+Общие настройки офлайн-тестов: main.py поднимается на временном каталоге
+данных, Telegram подменяется FakeTelegramClient
+"""
+import os
+import tempfile
+
+# До импорта main: индекс, кэши и сокет фетчера - во временном каталоге
+os.environ["DATA_DIR"] = tempfile.mkdtemp(prefix="creative-test-")
+os.environ["APP_ROLE"] = "all"
+
+import pytest
+
+import main
+from fake_telegram import FakeTelegramClient
+
+
+@pytest.fixture
+def fake_telegram(monkeypatch):
+    """Подключенный фейковый Telegram без задержек"""
+    client = FakeTelegramClient(latency=0, jitter=0)
+    monkeypatch.setattr(main.telegram_client, "client", client)
+    main.telegram_client.set_connected(True)
+    yield client
+    main.telegram_client.set_connected(False)
+
+
+@pytest.fixture
+def category(monkeypatch, request):
+    """Отдельная категория теста со своими каналами: тесты делят один индекс"""
+    def make(channels):
+        name = request.node.name.replace("[", "_").rstrip("]")
+        monkeypatch.setitem(main.REAL_CHANNELS, name, channels)
+        for channel in channels:
+            monkeypatch.setitem(main.CHANNEL_CATEGORIES, channel, name)
+        return name
+    return make
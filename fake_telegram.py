@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+"""
+Фейковый Telegram клиент для офлайн-тестов и бенчмарков
+
+Повторяет ту часть интерфейса Telethon, которой пользуется main.py:
+get_entity, iter_messages, get_messages, download_media, iter_download и
+add_event_handler (новые сообщения публикуются через emit_message).
+Задержка, FloodWait и размер фото настраиваются; часть фото - репосты
+одной картинки в разных каналах (repost_rate), как в fashion-каналах.
+"""
+import asyncio
+import io
+import random
+import struct
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+from telethon.errors import FloodWaitError
+
+
+class FakeTelegramClient:
+    def __init__(self, latency: float = 0.05, jitter: float = 0.02, flood_rate: float = 0.0,
+                 flood_seconds: int = 2, messages_per_channel: int = 500,
+                 photo_size=(1080, 1350), chunk_size: int = 128 * 1024, repost_rate: float = 0.1,
+                 seed: int = 42):
+        self.latency = latency
+        self.jitter = jitter
+        self.flood_rate = flood_rate
+        self.flood_seconds = flood_seconds
+        self.messages_per_channel = messages_per_channel
+        self.chunk_size = chunk_size
+        self.repost_rate = repost_rate
+        self.random = random.Random(seed)
+        self.calls = {}
+        self._channels = {}  # username -> entity
+        self._messages = {}  # channel id -> {message_id: message}
+        self._photos = self._make_photos(photo_size)
+        self._handlers = []
+
+    @staticmethod
+    def _make_photos(size):
+        """Небольшой набор JPEG-градиентов, из которых собираются фото сообщений"""
+        from PIL import Image
+
+        photos = []
+        for i in range(8):
+            image = Image.linear_gradient("L").resize(size).convert("RGB")
+            overlay = Image.new("RGB", size, ((i * 40) % 256, (i * 90) % 256, (i * 150) % 256))
+            buffer = io.BytesIO()
+            Image.blend(image, overlay, 0.5).save(buffer, format="JPEG", quality=85)
+            photos.append(buffer.getvalue())
+        return photos
+
+    async def _rpc(self, method: str):
+        """Имитация сетевого вызова: задержка и, с заданной вероятностью, FloodWait"""
+        self.calls[method] = self.calls.get(method, 0) + 1
+        await asyncio.sleep(max(0.0, self.latency + self.random.uniform(-self.jitter, self.jitter)))
+        if self.flood_rate and self.random.random() < self.flood_rate:
+            raise FloodWaitError(None, capture=self.flood_seconds)
+
+    def _channel_id(self, entity):
+        # Из кэша main.py приходит InputPeerChannel, из get_entity - наш entity
+        return getattr(entity, "channel_id", None) or entity.id
+
+    def _channel_messages(self, channel_id: int):
+        messages = self._messages.get(channel_id)
+        if messages is None:
+            rnd = random.Random(channel_id)
+            now = datetime.now(timezone.utc)
+            messages = {}
+            for message_id in range(1, self.messages_per_channel + 1):
+                age = timedelta(hours=(self.messages_per_channel - message_id) * 3)
+                views = int(rnd.lognormvariate(8, 1.2))
+                messages[message_id] = SimpleNamespace(
+                    id=message_id,
+                    text=f"Post {message_id} #fashion #style new collection",
+                    views=views,
+                    reactions=SimpleNamespace(results=[SimpleNamespace(count=views // 50)]),
+                    replies=SimpleNamespace(replies=views // 200),
+                    date=now - age,
+                    photo=self._make_photo(rnd, channel_id * 1_000_000 + message_id) if rnd.random() < 0.8 else None
+                )
+            self._messages[channel_id] = messages
+        return messages
+
+    def _make_photo(self, rnd, photo_id: int):
+        # content - что изображено: у репостов она общая из небольшого набора
+        content = rnd.randrange(50) if rnd.random() < self.repost_rate else photo_id
+        return SimpleNamespace(id=photo_id, content=content)
+    
+    async def start(self):
+        return self
+
+    async def disconnect(self):
+        pass
+
+    def is_connected(self):
+        return True
+
+    def add_event_handler(self, callback, event=None):
+        self._handlers.append((callback, event))
+
+    async def emit_message(self, username: str, views: int = 5000, text: str = "Fresh post #new"):
+        """Публикует новое сообщение в канале и вызывает подписанные обработчики, как Telethon"""
+        entity = await self.get_entity(username)
+        messages = self._channel_messages(entity.id)
+        message_id = max(messages) + 1
+        message = SimpleNamespace(
+            id=message_id,
+            peer_id=SimpleNamespace(channel_id=entity.id),
+            text=text,
+            views=views,
+            reactions=None,
+            replies=None,
+            date=datetime.now(timezone.utc),
+            photo=SimpleNamespace(id=entity.id * 1_000_000 + message_id, content=entity.id * 1_000_000 + message_id)
+        )
+        messages[message_id] = message
+        for handler, event in self._handlers:
+            if event is None or type(event).__name__ == "NewMessage":
+                await handler(SimpleNamespace(message=message))
+        return message
+
+    async def get_entity(self, username: str):
+        await self._rpc("get_entity")
+        username = username.lstrip("@").lower()
+        entity = self._channels.get(username)
+        if entity is None:
+            entity = SimpleNamespace(
+                id=len(self._channels) + 1000,
+                access_hash=random.Random(username).getrandbits(63),
+                username=username,
+                title=username.title()
+            )
+            self._channels[username] = entity
+        return entity
+
+    async def iter_messages(self, entity, limit=None, min_id: int = 0, reverse: bool = False, **kwargs):
+        messages = self._channel_messages(self._channel_id(entity))
+        # Как Telethon: по умолчанию от новых к старым, reverse=True - от min_id вверх
+        message_ids = sorted((i for i in messages if i > min_id), reverse=not reverse)
+        if limit is not None:
+            message_ids = message_ids[:limit]
+        # Как Telethon: один запрос на каждые 100 сообщений
+        for start in range(0, len(message_ids), 100):
+            await self._rpc("iter_messages")
+            for message_id in message_ids[start:start + 100]:
+                yield messages[message_id]
+
+    async def get_messages(self, entity, ids=None, limit=None, **kwargs):
+        if ids is None:
+            return [message async for message in self.iter_messages(entity, limit=limit, **kwargs)]
+        await self._rpc("get_messages")
+        messages = self._channel_messages(self._channel_id(entity))
+        if isinstance(ids, list):
+            return [messages.get(message_id) for message_id in ids]
+        return messages.get(ids)
+
+    def _photo_bytes(self, photo):
+        # Уникальный хвост после JPEG EOI: у каждого сообщения свой файл, декодеры его игнорируют
+        return self._photos[photo.id % len(self._photos)] + struct.pack(">Q", photo.id)
+
+    @staticmethod
+    def _thumb_bytes(photo):
+        """Маленькая миниатюра: шум, определяемый содержимым фото, чтобы у репостов совпадал dHash"""
+        import numpy as np
+        from PIL import Image
+        
+        pixels = np.random.default_rng(photo.content).integers(0, 256, (12, 12), dtype=np.uint8)
+        buffer = io.BytesIO()
+        Image.fromarray(pixels, "L").resize((90, 90)).convert("RGB").save(buffer, format="JPEG", quality=80)
+        return buffer.getvalue()
+    
+    async def download_media(self, media, file=None, thumb=None, **kwargs):
+        await self._rpc("download_media")
+        photo = getattr(media, "photo", None) or media
+        if thumb is not None:
+            return self._thumb_bytes(photo)
+        return self._photo_bytes(photo)
+
+    async def iter_download(self, media, **kwargs):
+        data = self._photo_bytes(getattr(media, "photo", None) or media)
+        for start in range(0, len(data), self.chunk_size):
+            await self._rpc("download_media")
+            yield data[start:start + self.chunk_size]
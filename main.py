@@ -2,284 +2,2955 @@
 """
 Исправленный стабильный сервер с реальными данными из Telegram
 """
-from fastapi import FastAPI, HTTPException
-from fastapi.responses import HTMLResponse, StreamingResponse
-from pydantic import BaseModel
-import io
-import requests
+from fastapi import FastAPI, HTTPException, Query, Request
+from fastapi.responses import HTMLResponse, FileResponse, JSONResponse, Response, StreamingResponse
+from pydantic import BaseModel, Field
 import logging
 import os
 import asyncio
-from datetime import datetime, timedelta
+import base64
+import gzip
+import hashlib
+import heapq
+import io
+import itertools
+import json
+import math
+import re
+import sqlite3
+import tempfile
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta, timezone
 import random
+import numpy as np
+import orjson
+from pydantic import TypeAdapter
 from dotenv import load_dotenv
 
-# Загружаем переменные окружения
-load_dotenv()
+try:
+    import brotli
+except ImportError:  # brotli необязателен: без него отдаем gzip
+    brotli = None
+
+# Загружаем переменные окружения
+load_dotenv()
+
+# Настройка логирования
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+@asynccontextmanager
+async def lifespan(app):
+    """Запуск и остановка: подключение, прогрев и фоновые задачи - в startup() и shutdown() ниже"""
+    await startup()
+    try:
+        yield
+    finally:
+        await shutdown()
+
+app = FastAPI(title="Creative MVP - Telegram Real Data Server", lifespan=lifespan)
+
+# Модели данных
+class FeedItem(BaseModel):
+    id: str
+    channel: str
+    message_id: int
+    category: str
+    media_type: str
+    text: str
+    views: int
+    likes: int
+    comments: int
+    date: str
+    media_url: str
+    post_url: str
+    score: float = 0.0
+
+feed_items = TypeAdapter(list[FeedItem])
+
+class PromptReq(BaseModel):
+    feed_item_id: str
+    text: str = ""  # подпись из карточки ленты - на случай, если поста нет в индексе
+
+class PromptBatchReq(BaseModel):
+    feed_item_ids: list[str] = Field(min_length=1, max_length=100)
+    texts: dict[str, str] = {}  # feed_item_id -> подпись из карточки ленты
+
+# Реальные рабочие каналы (только проверенные) - по умолчанию, если нет channels.json
+DEFAULT_CHANNELS = {
+    "fashion": ["rogov24", "burimovasasha", "zarina_brand"],
+    "beauty": ["goldapple_ru", "glamguruu"],
+    "home": ["casacozy", "homiesapiens"]
+}
+
+# Каналы по категориям читаются из JSON-файла {"категория": ["username", ...]}
+# и перечитываются на лету, когда файл меняется
+CHANNELS_FILE = os.getenv("CHANNELS_FILE", os.path.join(os.path.dirname(os.path.abspath(__file__)), "channels.json"))
+REAL_CHANNELS = {}
+CHANNEL_CATEGORIES = {}  # username -> категория
+_channels_mtime = None
+
+def load_channels():
+    """Перечитывает CHANNELS_FILE, если он изменился; словари обновляются на месте"""
+    global _channels_mtime
+    try:
+        mtime = os.path.getmtime(CHANNELS_FILE)
+    except OSError:
+        mtime = None
+    if REAL_CHANNELS and mtime == _channels_mtime:
+        return
+    
+    channels = DEFAULT_CHANNELS
+    if mtime is not None:
+        try:
+            with open(CHANNELS_FILE) as f:
+                channels = json.load(f)
+        except Exception as e:
+            logger.error(f"❌ Failed to read {CHANNELS_FILE}, keeping current channels: {e}")
+            if REAL_CHANNELS:
+                return
+    
+    _channels_mtime = mtime
+    REAL_CHANNELS.clear()
+    REAL_CHANNELS.update({category: list(dict.fromkeys(usernames)) for category, usernames in channels.items()})
+    CHANNEL_CATEGORIES.clear()
+    CHANNEL_CATEGORIES.update({ch: category for category, usernames in REAL_CHANNELS.items() for ch in usernames})
+    logger.info(f"📋 Loaded {len(CHANNEL_CATEGORIES)} channels in {len(REAL_CHANNELS)} categories")
+
+load_channels()
+
+# Как часто каждый процесс (веб-воркер, фетчер, одиночный сервер) проверяет mtime CHANNELS_FILE
+CHANNELS_RELOAD_INTERVAL = float(os.getenv("CHANNELS_RELOAD_INTERVAL", "5"))
+
+# Режим процесса: all - один процесс делает все (по умолчанию);
+# fetcher - единственный владелец сессии Telegram, слушает Unix-сокет;
+# web - HTTP-воркер без Telegram, читает общий индекс и кэш фото, а промахи
+# отправляет фетчеру. WEB_WORKERS > 1 при запуске main.py поднимает фетчер и N воркеров
+APP_ROLE = os.getenv("APP_ROLE", "all")
+WEB_WORKERS = int(os.getenv("WEB_WORKERS", "1"))
+PORT = int(os.getenv("PORT", "8000"))
+
+# Параллельная загрузка каналов: сколько каналов грузим одновременно
+# и сколько секунд ждем один канал, прежде чем отдать частичный результат
+FETCH_CONCURRENCY = int(os.getenv("FETCH_CONCURRENCY", "4"))
+CHANNEL_TIMEOUT = float(os.getenv("CHANNEL_TIMEOUT", "8"))
+FEED_PAGE_SIZE = 25
+FEED_MAX_LIMIT = 200
+
+# Старт и переподключение к Telegram
+STARTUP_TIMEOUT = float(os.getenv("STARTUP_TIMEOUT", "30"))  # подключение + прогрев до приема запросов
+RECONNECT_MIN_DELAY = float(os.getenv("RECONNECT_MIN_DELAY", "1"))
+RECONNECT_MAX_DELAY = float(os.getenv("RECONNECT_MAX_DELAY", "300"))
+CONNECTION_CHECK_INTERVAL = float(os.getenv("CONNECTION_CHECK_INTERVAL", "5"))
+LIVENESS_MAX_LAG = float(os.getenv("LIVENESS_MAX_LAG", "10"))
+
+# Каталог для локальных данных (кэши, индексы). Относительный путь считается от каталога
+# приложения, а не от cwd: фетчер и веб-воркеры должны видеть одни и те же файлы и сокет
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.getenv("DATA_DIR", "data"))
+os.makedirs(DATA_DIR, exist_ok=True)
+
+# Unix-сокет фетчера в режиме нескольких воркеров
+FETCHER_SOCKET = os.path.join(DATA_DIR, os.getenv("FETCHER_SOCKET", "fetcher.sock"))
+# Соединений одного web-воркера к фетчеру; SSE ходит отдельным клиентом и в этот лимит не входит
+FETCHER_MAX_CONNECTIONS = int(os.getenv("FETCHER_MAX_CONNECTIONS", "100"))
+
+# Кэш резолва username -> peer: файл и срок жизни записи в секундах
+ENTITY_CACHE_FILE = os.getenv("ENTITY_CACHE_FILE", os.path.join(DATA_DIR, "entities.json"))
+ENTITY_CACHE_TTL = float(os.getenv("ENTITY_CACHE_TTL", str(24 * 3600)))
+
+# Дисковый кэш фото: каталог и лимит размера в байтах
+PHOTO_CACHE_DIR = os.getenv("PHOTO_CACHE_DIR", os.path.join(DATA_DIR, "photos"))
+PHOTO_CACHE_MAX_BYTES = int(os.getenv("PHOTO_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+PHOTO_CACHE_CONTROL = "public, max-age=86400"
+
+# Заглушка, которую отдаем вместо фото в демо-режиме и при ошибках
+PLACEHOLDER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static", "placeholder.svg")
+
+# Варианты фото: допустимые ширины (запрошенная округляется вверх), форматы и пул процессов
+PHOTO_WIDTHS = (200, 400, 800, 1200)
+PHOTO_FORMATS = {"jpeg": "image/jpeg", "webp": "image/webp"}
+PHOTO_QUALITY = int(os.getenv("PHOTO_QUALITY", "80"))
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", str(os.cpu_count() or 2)))
+
+# Окно, за которое одновременные запросы сообщений канала собираются в один get_messages
+MESSAGE_BATCH_WINDOW = float(os.getenv("MESSAGE_BATCH_WINDOW", "0.02"))
+
+# Признаки постов для промптов. Фото берем тем же вариантом, что показывает UI, - он уже в кэше
+FEATURE_PHOTO_WIDTH = 400
+FEATURE_PHOTO_FORMAT = "webp"
+FEATURE_SAMPLE_SIZE = 64  # палитра считается по копии не больше 64x64
+PALETTE_SIZE = 5
+FEATURES_VERSION = 1  # поднять при изменении извлечения - старые признаки пересчитаются
+FEATURE_CACHE_SIZE = int(os.getenv("FEATURE_CACHE_SIZE", "4096"))
+
+# Локальный индекс постов и фоновая загрузка. Интервалы опроса и обновления
+# счетчиков подбираются по активности канала в пределах [MIN, MAX]; каналам
+# без истории достаются стартовые INGEST_INTERVAL и COUNTS_REFRESH_INTERVAL
+POST_INDEX_PATH = os.getenv("POST_INDEX_PATH", os.path.join(DATA_DIR, "posts.db"))
+INGEST_INTERVAL = float(os.getenv("INGEST_INTERVAL", "60"))
+COUNTS_REFRESH_INTERVAL = float(os.getenv("COUNTS_REFRESH_INTERVAL", "600"))
+MIN_POLL_INTERVAL = float(os.getenv("MIN_POLL_INTERVAL", "60"))
+MAX_POLL_INTERVAL = float(os.getenv("MAX_POLL_INTERVAL", str(6 * 3600)))
+MIN_REFRESH_INTERVAL = float(os.getenv("MIN_REFRESH_INTERVAL", "300"))
+MAX_REFRESH_INTERVAL = float(os.getenv("MAX_REFRESH_INTERVAL", str(12 * 3600)))
+# За какой период считаем частоту публикаций канала
+POST_RATE_WINDOW = float(os.getenv("POST_RATE_WINDOW", str(7 * 24 * 3600)))
+# Счетчики обновляем, когда просмотры свежих постов выросли примерно на столько
+VIEW_REFRESH_STEP = float(os.getenv("VIEW_REFRESH_STEP", "2000"))
+# Общий бюджет фоновых RPC в минуту; при нехватке все интервалы растягиваются пропорционально
+INGEST_RPC_BUDGET = float(os.getenv("INGEST_RPC_BUDGET", "60"))
+COUNTS_REFRESH_POSTS = int(os.getenv("COUNTS_REFRESH_POSTS", "100"))
+INGEST_MAX_MESSAGES = int(os.getenv("INGEST_MAX_MESSAGES", "300"))
+# Почти одинаковые фото: dHash миниатюр, расстояние Хэмминга не больше DEDUP_MAX_DISTANCE из 64 бит
+DEDUP_MAX_DISTANCE = int(os.getenv("DEDUP_MAX_DISTANCE", "6"))
+# Фото без встроенной миниатюры хэшируются пачками по DEDUP_BATCH; пока такие есть,
+# на их RPC резервируется доля DEDUP_RPC_SHARE от INGEST_RPC_BUDGET
+DEDUP_BATCH = int(os.getenv("DEDUP_BATCH", "20"))
+DEDUP_RPC_SHARE = float(os.getenv("DEDUP_RPC_SHARE", "0.25"))
+MIN_VIEWS = 1000
+FALLBACK_IMAGE = "https://images.unsplash.com/photo-1441986300917-64674bd600d8?w=400&h=600&fit=crop"
+
+# Лимиты RPC к Telegram: метод -> (запросов в секунду, размер burst).
+# resolveUsername у Telegram самый строгий, скачивание файлов - самое мягкое
+RPC_RATES = {
+    "get_entity": (0.5, 5),
+    "iter_messages": (2, 10),
+    "get_messages": (5, 10),
+    "download_media": (10, 20)
+}
+# FloodWait дольше этого порога не пережидаем, а отдаем ошибку вызывающему
+FLOOD_WAIT_RETRY_MAX = float(os.getenv("FLOOD_WAIT_RETRY_MAX", "30"))
+
+# Кэш ленты: сколько секунд пост считается свежим и сколько ключей храним
+FEED_CACHE_TTL = float(os.getenv("FEED_CACHE_TTL", "60"))
+FEED_CACHE_SIZE = int(os.getenv("FEED_CACHE_SIZE", "512"))
+# Готовые (сериализованные и сжатые) ответы ленты живут, пока не изменились данные, но не дольше TTL
+FEED_RESPONSE_TTL = float(os.getenv("FEED_RESPONSE_TTL", "15"))
+FEED_RESPONSE_CACHE_SIZE = int(os.getenv("FEED_RESPONSE_CACHE_SIZE", "64"))
+
+# Ранжирование ленты: engagement = views + лайки и комментарии с весами,
+# скорость набора engagement с затуханием по возрасту поста
+RANK_LIKE_WEIGHT = float(os.getenv("RANK_LIKE_WEIGHT", "10"))
+RANK_COMMENT_WEIGHT = float(os.getenv("RANK_COMMENT_WEIGHT", "30"))
+RANK_HALF_LIFE_HOURS = float(os.getenv("RANK_HALF_LIFE_HOURS", "48"))
+RANK_AGE_OFFSET_HOURS = float(os.getenv("RANK_AGE_OFFSET_HOURS", "2"))
+# Нормализация по каналу: крупные каналы не вытесняют из ленты мелкие
+RANK_NORMALIZE_CHANNELS = os.getenv("RANK_NORMALIZE_CHANNELS", "1") == "1"
+
+# Метрики в текстовом формате Prometheus
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    pairs = ",".join(f'{name}="{str(value).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"' for name, value in labels)
+    return "{" + pairs + "}"
+
+class Counter:
+    def __init__(self, name: str, help_text: str):
+        self.name = name
+        self.help_text = help_text
+        self.values = {}  # tuple(sorted labels) -> value
+    
+    def inc(self, value: float = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        self.values[key] = self.values.get(key, 0) + value
+    
+    def set(self, value: float, **labels):
+        """Для счетчиков, которые ведутся в другом объекте и снимаются при запросе /metrics"""
+        self.values[tuple(sorted(labels.items()))] = value
+    
+    def render(self, kind: str = "counter"):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {kind}"]
+        lines += [f"{self.name}{_format_labels(labels)} {value}" for labels, value in self.values.items()]
+        return lines
+
+class Gauge(Counter):
+    def render(self):
+        return super().render("gauge")
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        self.values = {}  # labels -> [counts по бакетам, sum, count]
+    
+    def observe(self, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        entry = self.values.get(key)
+        if entry is None:
+            entry = self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                entry[0][i] += 1
+                break
+        entry[1] += value
+        entry[2] += 1
+    
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for labels, (counts, total, count) in self.values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f"{self.name}_bucket{_format_labels(labels + (('le', bound),))} {cumulative}")
+            lines.append(f"{self.name}_bucket{_format_labels(labels + (('le', '+Inf'),))} {count}")
+            lines.append(f"{self.name}_sum{_format_labels(labels)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(labels)} {count}")
+        return lines
+
+http_request_duration = Histogram("http_request_duration_seconds", "HTTP request latency by route")
+telegram_rpc_duration = Histogram("telegram_rpc_duration_seconds", "Telegram RPC latency by method")
+telegram_rpc_errors = Counter("telegram_rpc_errors_total", "Telegram RPC errors by method and error type")
+demo_fallbacks = Counter("demo_fallback_total", "Demo posts or placeholder photos served instead of real data")
+photo_bytes_served = Counter("photo_bytes_served_total", "Photo bytes sent by /photo")
+event_loop_lag = Histogram("event_loop_lag_seconds", "Delay of a periodic event loop wakeup past its deadline")
+feed_rank_duration = Histogram(
+    "feed_rank_duration_seconds", "Time to score and select the top posts of a feed",
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1)
+)
+
+class EntityCache:
+    """Кэш username -> input peer в памяти с сохранением на диск"""
+    def __init__(self, path: str, ttl: float):
+        self.path = path
+        self.ttl = ttl
+        self._entries = {}  # username -> {"id", "access_hash", "resolved_at"}
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self._load()
+    
+    @staticmethod
+    def _key(username: str):
+        return username.lstrip("@").lower()
+    
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                self._entries = json.load(f)
+            logger.info(f"📇 Loaded {len(self._entries)} cached entities")
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.warning(f"⚠️ Entity cache is unreadable, starting empty: {e}")
+    
+    def _save(self):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self._entries, f)
+        os.replace(tmp_path, self.path)
+    
+    def get(self, username: str):
+        """Возвращает InputPeerChannel или None, если записи нет или она устарела"""
+        entry = self._entries.get(self._key(username))
+        if entry is None or time.time() - entry["resolved_at"] > self.ttl:
+            self.misses += 1
+            return None
+        
+        from telethon.tl.types import InputPeerChannel
+        self.hits += 1
+        return InputPeerChannel(entry["id"], entry["access_hash"])
+    
+    def set(self, username: str, entity):
+        key = self._key(username)
+        # Тот же канал под другим username - значит канал переименовали
+        for old_key in [k for k, v in self._entries.items() if v["id"] == entity.id and k != key]:
+            logger.info(f"🔁 Channel {old_key} was renamed to {key}")
+            del self._entries[old_key]
+            self.invalidations += 1
+        
+        self._entries[key] = {
+            "id": entity.id,
+            "access_hash": entity.access_hash,
+            "resolved_at": time.time()
+        }
+        self._save()
+    
+    def username_for(self, channel_id: int):
+        """Username по id канала - для событий Telegram, где есть только peer id"""
+        for username, entry in self._entries.items():
+            if entry["id"] == channel_id:
+                return username
+        return None
+    
+    def invalidate(self, username: str):
+        if self._entries.pop(self._key(username), None) is not None:
+            self.invalidations += 1
+            self._save()
+    
+    def stats(self):
+        return {
+            "size": len(self._entries),
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "invalidations": self.invalidations
+        }
+
+entity_cache = EntityCache(ENTITY_CACHE_FILE, ENTITY_CACHE_TTL)
+
+def is_stale_peer_error(error: Exception):
+    """Ошибка говорит, что сохраненный peer больше не годится (канал переименован, закрыт или удален)
+    
+    Сеть, таймауты и FloodWait к peer отношения не имеют - сбрасывать кэш из-за них
+    значит тратить лишний ResolveUsername на каждый сбой.
+    """
+    from telethon.errors import (ChannelInvalidError, ChannelPrivateError,
+                                 UsernameInvalidError, UsernameNotOccupiedError)
+    # ValueError Telethon бросает, когда не может найти сущность по username/peer
+    return isinstance(error, (ChannelInvalidError, ChannelPrivateError, UsernameInvalidError,
+                              UsernameNotOccupiedError, ValueError))
+
+class PhotoCache:
+    """Дисковый content-addressed кэш фото с LRU-вытеснением по размеру
+    
+    blobs/<sha256> - содержимое файла, refs/<key> - sha256 для ключа.
+    Одинаковые фото из разных сообщений хранятся одним файлом.
+    """
+    def __init__(self, root: str, max_bytes: int):
+        self.blobs_dir = os.path.join(root, "blobs")
+        self.refs_dir = os.path.join(root, "refs")
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(self.blobs_dir, exist_ok=True)
+        os.makedirs(self.refs_dir, exist_ok=True)
+        self.total_bytes = sum(entry.stat().st_size for entry in os.scandir(self.blobs_dir))
+    
+    def _ref_path(self, key: str):
+        return os.path.join(self.refs_dir, key)
+    
+    def blob_path(self, digest: str):
+        return os.path.join(self.blobs_dir, digest)
+    
+    def digest(self, key: str):
+        """sha256 фото для ключа без чтения самого файла, либо None"""
+        try:
+            with open(self._ref_path(key)) as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+    
+    def get(self, key: str):
+        """Возвращает (path, digest) закэшированного фото или None"""
+        digest = self.digest(key)
+        if digest is not None:
+            path = self.blob_path(digest)
+            try:
+                # mtime служит меткой последнего доступа для LRU
+                os.utime(path)
+                self.hits += 1
+                return path, digest
+            except FileNotFoundError:
+                # Файл уже вытеснен - ссылка больше не нужна
+                os.remove(self._ref_path(key))
+        self.misses += 1
+        return None
+    
+    def temp_path(self):
+        """Путь для временного файла, который потом передается в commit"""
+        fd, path = tempfile.mkstemp(dir=self.blobs_dir, suffix=".tmp")
+        os.close(fd)
+        return path
+    
+    def commit(self, key: str, tmp_path: str, digest: str, size: int):
+        """Переносит готовый временный файл в кэш и возвращает (path, digest)"""
+        path = self.blob_path(digest)
+        if os.path.exists(path):
+            os.remove(tmp_path)
+        else:
+            os.replace(tmp_path, path)
+            self.total_bytes += size
+        
+        ref_path = self._ref_path(key)
+        os.makedirs(os.path.dirname(ref_path), exist_ok=True)
+        with open(f"{ref_path}.tmp", "w") as f:
+            f.write(digest)
+        os.replace(f"{ref_path}.tmp", ref_path)
+        
+        if self.total_bytes > self.max_bytes:
+            self._evict()
+        return path, digest
+    
+    def put(self, key: str, data: bytes):
+        """Сохраняет фото и возвращает (path, digest)"""
+        tmp_path = self.temp_path()
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        return self.commit(key, tmp_path, hashlib.sha256(data).hexdigest(), len(data))
+    
+    def _evict(self):
+        """Удаляет давно не запрошенные файлы, пока кэш не уменьшится до 90% лимита"""
+        entries = sorted(
+            (entry for entry in os.scandir(self.blobs_dir) if not entry.name.endswith(".tmp")),
+            key=lambda entry: entry.stat().st_mtime
+        )
+        self.total_bytes = sum(entry.stat().st_size for entry in entries)
+        for entry in entries:
+            if self.total_bytes <= self.max_bytes * 0.9:
+                break
+            size = entry.stat().st_size
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                continue
+            self.total_bytes -= size
+            self.evictions += 1
+        logger.info(f"🧹 Photo cache evicted down to {self.total_bytes} bytes")
+    
+    def stats(self):
+        return {
+            "bytes": self.total_bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions
+        }
+
+photo_cache = PhotoCache(PHOTO_CACHE_DIR, PHOTO_CACHE_MAX_BYTES)
+
+def message_row(channel_username: str, message):
+    """Строка индекса из сообщения Telethon"""
+    reactions = message.reactions.results if message.reactions else []
+    return {
+        'channel': channel_username,
+        'message_id': message.id,
+        'text': message.text or "",
+        'views': message.views or 0,
+        'likes': sum(reaction.count for reaction in reactions),
+        'comments': message.replies.replies if message.replies else 0,
+        'date': message.date.isoformat(),
+        'has_photo': bool(message.photo)
+    }
+
+def post_from_row(row):
+    """Пост ленты из строки индекса"""
+    channel_username = row['channel']
+    message_id = row['message_id']
+    return {
+        'id': f"{channel_username}_{message_id}",
+        'channel': channel_username,
+        'message_id': message_id,
+        'category': CHANNEL_CATEGORIES.get(channel_username, ""),
+        'media_type': "photo" if row['has_photo'] else "text",
+        'text': (row['text'] or "No text")[:200],
+        'views': row['views'],
+        'likes': row['likes'],
+        'comments': row['comments'],
+        'date': row['date'],
+        'media_url': f"/photo/{channel_username}/{message_id}" if row['has_photo'] else FALLBACK_IMAGE,
+        'post_url': f"https://t.me/{channel_username}/{message_id}"
+    }
+
+class PostIndex:
+    """Локальный SQLite-индекс постов и состояние загрузки по каналам"""
+    def __init__(self, path: str):
+        self.path = path
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS posts (
+                channel TEXT NOT NULL,
+                message_id INTEGER NOT NULL,
+                text TEXT NOT NULL,
+                views INTEGER NOT NULL,
+                likes INTEGER NOT NULL,
+                comments INTEGER NOT NULL,
+                date TEXT NOT NULL,
+                has_photo INTEGER NOT NULL,
+                updated_at REAL NOT NULL,
+                PRIMARY KEY (channel, message_id)
+            );
+            CREATE INDEX IF NOT EXISTS posts_channel_views ON posts (channel, views);
+            CREATE TABLE IF NOT EXISTS channels (
+                channel TEXT PRIMARY KEY,
+                max_id INTEGER NOT NULL DEFAULT 0,
+                polled_at REAL,
+                refreshed_at REAL
+            );
+            CREATE TABLE IF NOT EXISTS features (
+                channel TEXT NOT NULL,
+                message_id INTEGER NOT NULL,
+                version INTEGER NOT NULL,
+                data TEXT NOT NULL,
+                updated_at REAL NOT NULL,
+                PRIMARY KEY (channel, message_id)
+            );
+        """)
+        # Колонки добавлены позже - докатываем их на старые базы
+        for table, added in (("channels", {"post_rate": "REAL", "view_growth": "REAL"}),
+                             ("posts", {"phash": "INTEGER", "cluster": "TEXT"})):
+            columns = {row['name'] for row in self.db.execute(f"PRAGMA table_info({table})")}
+            for column, column_type in added.items():
+                if column not in columns:
+                    self.db.execute(f"ALTER TABLE {table} ADD COLUMN {column} {column_type}")
+        self.db.executescript("""
+            CREATE INDEX IF NOT EXISTS posts_unhashed ON posts (date) WHERE has_photo AND cluster IS NULL;
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL);
+            INSERT OR IGNORE INTO meta (key, value) VALUES ('feed_version', 0);
+        """)
+        self.db.commit()
+    
+    def version(self):
+        """Версия содержимого постов, общая для всех процессов
+        
+        Растет только при upsert, изменившем хотя бы одну строку: служебные записи
+        (состояние каналов, хэши фото, признаки) и повторные записи тех же
+        счетчиков не сбрасывают пул ранжирования и готовые ответы.
+        Новые кластеры дубликатов попадают в ленту со следующим upsert.
+        """
+        return self.db.execute("SELECT value FROM meta WHERE key = 'feed_version'").fetchone()[0]
+    
+    def upsert(self, rows):
+        """Пишет посты; возвращает число вставленных или реально измененных строк"""
+        now = time.time()
+        before = self.db.total_changes
+        self.db.executemany("""
+            INSERT INTO posts (channel, message_id, text, views, likes, comments, date, has_photo, updated_at)
+            VALUES (:channel, :message_id, :text, :views, :likes, :comments, :date, :has_photo, :updated_at)
+            ON CONFLICT (channel, message_id) DO UPDATE SET
+                text = excluded.text,
+                views = excluded.views,
+                likes = excluded.likes,
+                comments = excluded.comments,
+                has_photo = excluded.has_photo,
+                updated_at = excluded.updated_at
+            WHERE posts.text IS NOT excluded.text OR posts.views != excluded.views
+               OR posts.likes != excluded.likes OR posts.comments != excluded.comments
+               OR posts.has_photo != excluded.has_photo
+        """, [{**row, 'updated_at': now} for row in rows])
+        changed = self.db.total_changes - before
+        if changed:
+            self.db.execute("UPDATE meta SET value = value + 1 WHERE key = 'feed_version'")
+        self.db.commit()
+        return changed
+    
+    def channel_state(self, channel: str):
+        """Состояние загрузки канала: max_id, polled_at, refreshed_at или None"""
+        return self.db.execute("SELECT * FROM channels WHERE channel = ?", (channel,)).fetchone()
+    
+    def channel_states(self):
+        return {row['channel']: row for row in self.db.execute("SELECT * FROM channels")}
+    
+    def mark_polled(self, channel: str, max_id: int, post_rate=None):
+        self.db.execute("""
+            INSERT INTO channels (channel, max_id, polled_at, post_rate) VALUES (?, ?, ?, ?)
+            ON CONFLICT (channel) DO UPDATE SET
+                max_id = max(max_id, excluded.max_id),
+                polled_at = excluded.polled_at,
+                post_rate = coalesce(excluded.post_rate, post_rate)
+        """, (channel, max_id, time.time(), post_rate))
+        self.db.commit()
+    
+    def mark_refreshed(self, channel: str, view_growth=None):
+        self.db.execute(
+            "UPDATE channels SET refreshed_at = ?, view_growth = coalesce(?, view_growth) WHERE channel = ?",
+            (time.time(), view_growth, channel)
+        )
+        self.db.commit()
+    
+    def recent_ids(self, channel: str, limit: int):
+        rows = self.db.execute(
+            "SELECT message_id FROM posts WHERE channel = ? ORDER BY message_id DESC LIMIT ?",
+            (channel, limit)
+        )
+        return [row['message_id'] for row in rows]
+    
+    def views(self, channel: str, ids):
+        """Текущие просмотры постов канала из индекса: {message_id: views}"""
+        placeholders = ",".join("?" * len(ids))
+        rows = self.db.execute(
+            f"SELECT message_id, views FROM posts WHERE channel = ? AND message_id IN ({placeholders})",
+            (channel, *ids)
+        )
+        return {row['message_id']: row['views'] for row in rows}
+    
+    def post_rate(self, channel: str, window: float):
+        """Постов в час за последние window секунд - по датам постов в индексе"""
+        since = datetime.fromtimestamp(time.time() - window, timezone.utc).isoformat()
+        count = self.db.execute(
+            "SELECT count(*) FROM posts WHERE channel = ? AND date >= ?", (channel, since)
+        ).fetchone()[0]
+        return count / (window / 3600)
+    
+    def candidates(self, channels, min_views: int):
+        """Все посты каналов выше порога просмотров - пул кандидатов для ранжирования
+        
+        Читает через собственное соединение: вызывается из потока, пока основное
+        соединение пишет в цикле событий (WAL позволяет читать параллельно).
+        """
+        placeholders = ",".join("?" * len(channels))
+        db = sqlite3.connect(self.path)
+        db.row_factory = sqlite3.Row
+        try:
+            return db.execute(f"""
+                SELECT channel, message_id, text, views, likes, comments, date, has_photo,
+                       (julianday(date) - 2440587.5) * 86400.0 AS ts, cluster
+                FROM posts
+                WHERE channel IN ({placeholders}) AND views >= ?
+            """, (*channels, min_views)).fetchall()
+        finally:
+            db.close()
+    
+    def set_photo_hashes(self, rows):
+        """rows: (channel, message_id, phash или None, cluster)"""
+        self.db.executemany(
+            "UPDATE posts SET phash = ?, cluster = ? WHERE channel = ? AND message_id = ?",
+            [(to_signed64(phash), cluster, channel, message_id) for channel, message_id, phash, cluster in rows]
+        )
+        self.db.commit()
+    
+    def photo_hashes(self):
+        """Все посчитанные хэши: [(phash, cluster)]"""
+        rows = self.db.execute("SELECT phash, cluster FROM posts WHERE phash IS NOT NULL")
+        return [(row['phash'] & (2 ** 64 - 1), row['cluster']) for row in rows]
+    
+    def has_unhashed_photos(self):
+        return self.db.execute(
+            "SELECT 1 FROM posts WHERE has_photo AND cluster IS NULL LIMIT 1"
+        ).fetchone() is not None
+    
+    def unhashed_photos(self, limit: int):
+        """Посты с фото, которые еще не проходили дедупликацию, сначала свежие"""
+        return self.db.execute(
+            "SELECT channel, message_id FROM posts WHERE has_photo AND cluster IS NULL ORDER BY date DESC LIMIT ?",
+            (limit,)
+        ).fetchall()
+    
+    def posts(self, keys):
+        """Строки постов по ключам (channel, message_id): {key: row}"""
+        rows = {}
+        for channel, message_id in keys:
+            row = self.db.execute(
+                "SELECT * FROM posts WHERE channel = ? AND message_id = ?", (channel, message_id)
+            ).fetchone()
+            if row is not None:
+                rows[(channel, message_id)] = row
+        return rows
+    
+    def features(self, keys, version: int):
+        """Сохраненные признаки постов текущей версии: {key: dict}"""
+        found = {}
+        for channel, message_id in keys:
+            row = self.db.execute(
+                "SELECT data FROM features WHERE channel = ? AND message_id = ? AND version = ?",
+                (channel, message_id, version)
+            ).fetchone()
+            if row is not None:
+                found[(channel, message_id)] = json.loads(row['data'])
+        return found
+    
+    def set_features(self, items, version: int):
+        now = time.time()
+        self.db.executemany("""
+            INSERT INTO features (channel, message_id, version, data, updated_at) VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (channel, message_id) DO UPDATE SET
+                version = excluded.version, data = excluded.data, updated_at = excluded.updated_at
+        """, [(channel, message_id, version, json.dumps(data), now) for (channel, message_id), data in items.items()])
+        self.db.commit()
+    
+    def photo_source(self, channel: str, message_id: int):
+        """(channel, message_id) поста, чье фото хранит кэш за весь кластер дубликатов"""
+        row = self.db.execute(
+            "SELECT cluster FROM posts WHERE channel = ? AND message_id = ?", (channel, message_id)
+        ).fetchone()
+        if row is None or not row['cluster']:
+            return channel, message_id
+        source_channel, _, source_id = row['cluster'].rpartition("/")
+        return source_channel, int(source_id)
+    
+    def stats(self):
+        return {
+            "posts": self.db.execute("SELECT count(*) FROM posts").fetchone()[0],
+            "channels": self.db.execute("SELECT count(*) FROM channels").fetchone()[0]
+        }
+
+def to_signed64(value):
+    """SQLite хранит INTEGER со знаком - 64-битный хэш сдвигаем в этот диапазон"""
+    if value is None or value < 2 ** 63:
+        return value
+    return value - 2 ** 64
+
+post_index = PostIndex(POST_INDEX_PATH)
+
+def engagement(views, likes, comments):
+    return views + RANK_LIKE_WEIGHT * likes + RANK_COMMENT_WEIGHT * comments
+
+class Candidates:
+    """Кандидаты ленты в колонках NumPy; посты собираются только для выбранного top-k"""
+    def __init__(self, items, channel_names, channel_codes, views, likes, comments, timestamps):
+        self.items = items  # строки индекса или готовые посты, в порядке колонок
+        self.channel_names = channel_names
+        self.channel_codes = channel_codes
+        self.views = views
+        self.likes = likes
+        self.comments = comments
+        self.timestamps = timestamps
+        # Посты, которые остаются в ленте после схлопывания дубликатов
+        self.canonical = np.ones(len(items), dtype=bool)
+    
+    def __len__(self):
+        return len(self.items)
+    
+    @classmethod
+    def from_columns(cls, items, channels, numeric):
+        channel_names, channel_codes = np.unique(np.array(channels, dtype=str), return_inverse=True)
+        numeric = np.array(numeric, dtype=np.float64).reshape(-1, 4)
+        return cls(items, [str(name) for name in channel_names], channel_codes, *numeric.T)
+    
+    @classmethod
+    def from_rows(cls, rows):
+        """Из строк PostIndex.candidates; в каждом кластере дубликатов остается пост с наибольшим engagement"""
+        candidates = cls.from_columns(
+            rows, [row[0] for row in rows], [(row[3], row[4], row[5], row[8]) for row in rows]
+        )
+        clusters = [row[9] or f"{row[0]}/{row[1]}" for row in rows]
+        if clusters:
+            _, codes = np.unique(np.array(clusters, dtype=str), return_inverse=True)
+            order = np.lexsort((-engagement(candidates.views, candidates.likes, candidates.comments), codes))
+            first = np.ones(len(order), dtype=bool)
+            first[1:] = codes[order][1:] != codes[order][:-1]
+            candidates.canonical = np.zeros(len(order), dtype=bool)
+            candidates.canonical[order[first]] = True
+        return candidates
+    
+    @classmethod
+    def from_posts(cls, posts):
+        """Из готовых постов ленты (живая загрузка канала)"""
+        return cls.from_columns(
+            posts,
+            [post['channel'] for post in posts],
+            [(post['views'], post['likes'], post['comments'], datetime.fromisoformat(post['date']).timestamp())
+             for post in posts]
+        )
+    
+    def concat(self, other):
+        offset = len(self.channel_names)
+        merged = Candidates(
+            self.items + other.items,
+            self.channel_names + other.channel_names,
+            np.concatenate([self.channel_codes, other.channel_codes + offset]),
+            *(np.concatenate([getattr(self, name), getattr(other, name)])
+              for name in ("views", "likes", "comments", "timestamps"))
+        )
+        merged.canonical = np.concatenate([self.canonical, other.canonical])
+        return merged
+    
+    def post_id(self, i: int):
+        item = self.items[i]
+        return f"{item['channel']}_{item['message_id']}"
+    
+    def post(self, i: int):
+        item = self.items[i]
+        return post_from_row(item) if isinstance(item, sqlite3.Row) else dict(item)
+
+def feed_order(post):
+    """Ключ порядка ленты: score по убыванию, при равенстве - id"""
+    return -post['score'], post['id']
+
+class FeedRanker:
+    """Ранжирование ленты одним векторным проходом и выбор top-k без полной сортировки
+    
+    Пул кандидатов из индекса держится в колонках между запросами и
+    пересобирается только после записи в индекс. Пересборка идет в потоке,
+    а запросы до ее окончания ранжируют предыдущий пул.
+    """
+    def __init__(self, index: PostIndex):
+        self.index = index
+        self._pools = {}  # tuple(channels) -> Candidates с атрибутом version
+        self._rebuilding = {}  # tuple(channels) -> asyncio.Task
+        self.rebuilds = 0
+        self.stale_served = 0
+    
+    async def pool(self, channels):
+        """Пул каналов; candidates.version - версия индекса, из которой он собран"""
+        key = tuple(channels)
+        version = self.index.version()
+        cached = self._pools.get(key)
+        if cached is not None and cached.version == version:
+            return cached
+        
+        task = self._rebuilding.get(key)
+        if task is None:
+            task = self._rebuilding[key] = asyncio.create_task(self._rebuild(key, version))
+        if cached is not None:
+            self.stale_served += 1
+            return cached
+        # shield: отмена одного запроса не должна отменять общую сборку
+        return await asyncio.shield(task)
+    
+    async def _rebuild(self, key, version):
+        try:
+            rows = await asyncio.to_thread(self.index.candidates, list(key), MIN_VIEWS)
+            candidates = await asyncio.to_thread(Candidates.from_rows, rows)
+            candidates.version = version
+            self._pools[key] = candidates
+            self.rebuilds += 1
+            return candidates
+        finally:
+            self._rebuilding.pop(key, None)
+    
+    @staticmethod
+    def score(candidates: Candidates, now: float, visible):
+        """Скорость набора engagement с экспоненциальным затуханием по возрасту
+        
+        Средние по каналу для нормализации считаются только по visible, чтобы
+        посты, которые в ленту не попадают, не сдвигали оценки остальных.
+        """
+        age_hours = np.maximum(now - candidates.timestamps, 0) / 3600
+        velocity = (engagement(candidates.views, candidates.likes, candidates.comments)
+                    / (age_hours + RANK_AGE_OFFSET_HOURS))
+        if RANK_NORMALIZE_CHANNELS:
+            codes = candidates.channel_codes
+            counts = np.bincount(codes, weights=visible, minlength=len(candidates.channel_names))
+            means = np.bincount(codes, weights=velocity * visible, minlength=len(candidates.channel_names))
+            means = means / np.maximum(counts, 1)
+            velocity = velocity / np.maximum(means[codes], 1e-9)
+        return velocity * np.exp2(-age_hours / RANK_HALF_LIFE_HOURS)
+    
+    @staticmethod
+    def top_k(scores, k: int):
+        """Индексы k лучших: argpartition вместо полной сортировки"""
+        if k <= 0 or len(scores) == 0:
+            return np.empty(0, dtype=np.intp)
+        if k < len(scores):
+            return np.argpartition(-scores, k - 1)[:k]
+        return np.arange(len(scores))
+    
+    def rank(self, candidates: Candidates, k: int, now: float = None, after=None):
+        """Top-k постов в порядке (score desc, id asc)
+        
+        Участвуют только канонические посты не новее now, и только они входят
+        в средние нормализации. Поэтому посты, пришедшие после as_of курсора,
+        не меняют оценки старых, и страницы с одним as_of не пересекаются.
+        Обновление счетчиков между страницами все же может сдвинуть пост
+        через границу страницы.
+        after - позиция курсора (score, id): берутся только посты строго после нее.
+        """
+        started = time.perf_counter()
+        now = time.time() if now is None else now
+        eligible = candidates.canonical & (candidates.timestamps <= now)
+        scores = self.score(candidates, now, eligible)
+        if after is not None:
+            after_score, after_id = after
+            ties = np.flatnonzero(eligible & (scores == after_score))
+            eligible &= scores < after_score
+            for i in ties:
+                eligible[i] = candidates.post_id(i) > after_id
+        k = min(k, int(np.count_nonzero(eligible)))
+        scores = np.where(eligible, scores, -np.inf)
+        
+        posts = []
+        for i in self.top_k(scores, k):
+            post = candidates.post(i)
+            post['score'] = float(scores[i])
+            posts.append(post)
+        posts.sort(key=feed_order)
+        feed_rank_duration.observe(time.perf_counter() - started)
+        return posts
+    
+    def stats(self):
+        return {
+            "pools": {",".join(key): len(candidates) for key, candidates in self._pools.items()},
+            "rebuilds": self.rebuilds,
+            "rebuilding": len(self._rebuilding),
+            "stale_served": self.stale_served
+        }
+
+feed_ranker = FeedRanker(post_index)
+
+def dhash(data: bytes):
+    """64-битный dHash: знак разности соседних пикселей уменьшенной до 9x8 копии в оттенках серого"""
+    from PIL import Image
+    
+    with Image.open(io.BytesIO(data)) as image:
+        image.draft("L", (32, 32))
+        pixels = np.asarray(image.convert("L").resize((9, 8), Image.BILINEAR), dtype=np.int16)
+    bits = pixels[:, 1:] > pixels[:, :-1]
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+def dhash_many(thumbs):
+    """Хэши пачки миниатюр (выполняется в пуле процессов); None для нечитаемых"""
+    hashes = []
+    for data in thumbs:
+        try:
+            hashes.append(dhash(data))
+        except Exception:
+            hashes.append(None)
+    return hashes
+
+def photo_thumb(message):
+    """Встроенная в сообщение миниатюра (PhotoStrippedSize) как JPEG - хэш без лишнего RPC"""
+    from telethon import utils
+    
+    for size in getattr(message.photo, "sizes", None) or []:
+        if type(size).__name__ == "PhotoStrippedSize":
+            return utils.stripped_photo_to_jpg(size.bytes)
+    return None
+
+class MultiIndexHash:
+    """Индекс 64-битных хэшей для поиска соседей по Хэммингу в радиусе radius
+    
+    Ключ режется на radius + 1 кусков, у каждого куска своя хэш-таблица: у
+    соседа в радиусе хотя бы один кусок совпадает точно, поэтому проверяются
+    только ключи из radius + 1 корзин, а не весь корпус.
+    """
+    def __init__(self, radius: int, bits: int = 64):
+        self.radius = radius
+        chunks = radius + 1
+        bounds = [round(i * bits / chunks) for i in range(chunks + 1)]
+        self.slices = [(low, (1 << (high - low)) - 1) for low, high in zip(bounds, bounds[1:])]
+        self.tables = [{} for _ in self.slices]
+        self.values = {}  # key -> value
+    
+    def __len__(self):
+        return len(self.values)
+    
+    def add(self, key: int, value):
+        if key in self.values:
+            return  # такой хэш уже есть, его значение и так находится поиском
+        self.values[key] = value
+        for table, (shift, mask) in zip(self.tables, self.slices):
+            table.setdefault((key >> shift) & mask, []).append(key)
+    
+    def search(self, key: int):
+        """[(distance, value)] всех ключей не дальше radius"""
+        found = {}
+        for table, (shift, mask) in zip(self.tables, self.slices):
+            for candidate in table.get((key >> shift) & mask, ()):
+                if candidate not in found:
+                    found[candidate] = (key ^ candidate).bit_count()
+        return [(distance, self.values[candidate]) for candidate, distance in found.items() if distance <= self.radius]
+
+class PhotoDedup:
+    """Кластеры почти одинаковых фото; id кластера - ключ кэша первого фото, "channel/message_id"
+    
+    Хэши - dHash миниатюр, соседи ищутся в MultiIndexHash. Новое фото
+    присоединяется к кластеру ближайшего хэша в радиусе max_distance.
+    """
+    def __init__(self, index: PostIndex, max_distance: int):
+        self.index = index
+        self.max_distance = max_distance
+        self._hashes = None
+        self.hashed = 0
+        self.duplicates = 0
+    
+    def hashes(self):
+        # Индекс хэшей нужен только процессу, который пишет в SQLite - грузим при первом использовании
+        if self._hashes is None:
+            self._hashes = MultiIndexHash(self.max_distance)
+            for phash, cluster in self.index.photo_hashes():
+                self._hashes.add(phash, cluster)
+        return self._hashes
+    
+    def assign(self, key: str, phash):
+        """Кластер для фото: ближайший в радиусе или новый с id key"""
+        if phash is None:
+            return key
+        matches = self.hashes().search(phash)
+        if matches:
+            self.duplicates += 1
+            cluster = min(matches)[1]
+        else:
+            cluster = key
+        self.hashes().add(phash, cluster)
+        return cluster
+    
+    async def add_thumbs(self, items):
+        """items: [(channel, message_id, миниатюра или None)] - хэширует и записывает кластеры в индекс"""
+        if not items:
+            return
+        hashes = await asyncio.get_running_loop().run_in_executor(
+            image_pool(), dhash_many, [thumb or b"" for _, _, thumb in items]
+        )
+        rows = []
+        for (channel, message_id, _), phash in zip(items, hashes):
+            rows.append((channel, message_id, phash, self.assign(f"{channel}/{message_id}", phash)))
+        self.hashed += len(rows)
+        self.index.set_photo_hashes(rows)
+    
+    def stats(self):
+        return {
+            "hashed": self.hashed,
+            "duplicates": self.duplicates,
+            "indexed_hashes": len(self._hashes) if self._hashes is not None else None,
+            "max_distance": self.max_distance
+        }
+
+photo_dedup = PhotoDedup(post_index, DEDUP_MAX_DISTANCE)
+
+# Приоритеты RPC: интерактивные запросы пользователей идут раньше фоновых
+INTERACTIVE = 0
+BACKGROUND = 1
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated_at = time.monotonic()
+    
+    def delay(self):
+        """Через сколько секунд появится токен (0 - уже есть)"""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+    
+    def take(self):
+        self.tokens -= 1
+
+class RpcScheduler:
+    """Единая очередь всех RPC к Telegram
+    
+    На каждый метод свой token bucket и своя очередь с приоритетами.
+    FloodWait приостанавливает только метод, который его получил.
+    """
+    def __init__(self, rates):
+        self.buckets = {method: TokenBucket(rate, burst) for method, (rate, burst) in rates.items()}
+        self.paused_until = {method: 0.0 for method in rates}
+        self._queues = {method: [] for method in rates}  # heap (priority, seq, future)
+        self._dispatchers = {}  # method -> asyncio.Task
+        self._seq = itertools.count()
+        self.waits = {
+            method: {priority: {"count": 0, "total_ms": 0.0, "max_ms": 0.0} for priority in (INTERACTIVE, BACKGROUND)}
+            for method in rates
+        }
+        self.flood_waits = {method: 0 for method in rates}
+    
+    def long_pause_error(self, method: str):
+        """FloodWaitError, если метод на паузе дольше FLOOD_WAIT_RETRY_MAX, иначе None"""
+        from telethon.errors import FloodWaitError
+        
+        pause = self.paused_until[method] - time.monotonic()
+        if pause > FLOOD_WAIT_RETRY_MAX:
+            return FloodWaitError(None, capture=math.ceil(pause))
+        return None
+    
+    async def acquire(self, method: str, priority: int):
+        """Ждет своей очереди и токена метода
+        
+        Длинную паузу после FloodWait не пережидаем: вызывающий сразу получает
+        FloodWaitError и уходит в фоллбек, а не висит в очереди до часа.
+        """
+        error = self.long_pause_error(method)
+        if error:
+            raise error
+        enqueued_at = time.monotonic()
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._queues[method], (priority, next(self._seq), future))
+        if method not in self._dispatchers:
+            self._dispatchers[method] = asyncio.create_task(self._dispatch(method))
+        await future
+        
+        waited_ms = (time.monotonic() - enqueued_at) * 1000
+        wait = self.waits[method][priority]
+        wait["count"] += 1
+        wait["total_ms"] += waited_ms
+        wait["max_ms"] = max(wait["max_ms"], waited_ms)
+    
+    async def _dispatch(self, method: str):
+        queue = self._queues[method]
+        bucket = self.buckets[method]
+        try:
+            while queue:
+                error = self.long_pause_error(method)
+                if error:
+                    # Пауза стала длинной, пока мы стояли в очереди - отпускаем всех ожидающих
+                    while queue:
+                        _, _, future = heapq.heappop(queue)
+                        if not future.done():
+                            future.set_exception(error)
+                    break
+                delay = max(self.paused_until[method] - time.monotonic(), bucket.delay())
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                    continue
+                _, _, future = heapq.heappop(queue)
+                # Ожидающий мог уйти по таймауту - токен ему уже не нужен
+                if not future.done():
+                    bucket.take()
+                    future.set_result(None)
+        finally:
+            self._dispatchers.pop(method, None)
+    
+    async def call(self, method: str, factory, priority: int = INTERACTIVE):
+        """Выполняет factory() в очереди метода, пережидая короткие FloodWait"""
+        from telethon.errors import FloodWaitError
+        
+        while True:
+            await self.acquire(method, priority)
+            started = time.monotonic()
+            try:
+                return await factory()
+            except FloodWaitError as e:
+                telegram_rpc_errors.inc(method=method, error=type(e).__name__)
+                self.flood_waits[method] += 1
+                self.paused_until[method] = max(self.paused_until[method], time.monotonic() + e.seconds)
+                logger.warning(f"🌊 FloodWait {e.seconds}s on {method}, pausing this method")
+                if e.seconds > FLOOD_WAIT_RETRY_MAX:
+                    raise
+            except Exception as e:
+                telegram_rpc_errors.inc(method=method, error=type(e).__name__)
+                raise
+            finally:
+                telegram_rpc_duration.observe(time.monotonic() - started, method=method)
+    
+    def stats(self):
+        now = time.monotonic()
+        return {
+            method: {
+                "queued": len(self._queues[method]),
+                "paused_for": round(max(0.0, self.paused_until[method] - now), 1),
+                "flood_waits": self.flood_waits[method],
+                "waits": {
+                    ("interactive" if priority == INTERACTIVE else "background"): {
+                        "count": wait["count"],
+                        "avg_ms": round(wait["total_ms"] / wait["count"], 1) if wait["count"] else 0,
+                        "max_ms": round(wait["max_ms"], 1)
+                    }
+                    for priority, wait in self.waits[method].items()
+                }
+            }
+            for method in self.buckets
+        }
+
+rpc_scheduler = RpcScheduler(RPC_RATES)
+
+async def collect(iterator):
+    """Собирает async-итератор Telethon в список, чтобы выполнить его одним вызовом планировщика"""
+    return [item async for item in iterator]
+
+# Telegram клиент
+class TelegramClient:
+    def __init__(self):
+        self.api_id = os.getenv("TELEGRAM_API_ID")
+        self.api_hash = os.getenv("TELEGRAM_API_HASH")
+        self.session_string = os.getenv("TELEGRAM_SESSION")
+        self.client = None
+        self.connected = False
+        self.connected_event = asyncio.Event()
+        self.supervisor = None
+        self.attempts = 0
+        self.reconnects = 0
+        self.last_error = None
+        self.next_attempt_at = None
+    
+    def has_credentials(self):
+        # Сессией владеет фетчер: вторая копия StringSession в web-воркере привела бы к конфликту сессий
+        return APP_ROLE != "web" and all([self.api_id, self.api_hash, self.session_string])
+    
+    def is_alive(self):
+        return self.connected and self.client is not None and self.client.is_connected()
+    
+    def state(self):
+        """connected, disconnected или demo (Telegram не настроен в этом процессе)"""
+        if self.is_alive():
+            return "connected"
+        return "disconnected" if self.has_credentials() else "demo"
+    
+    def set_connected(self, connected: bool):
+        self.connected = connected
+        if connected:
+            self.connected_event.set()
+        else:
+            self.connected_event.clear()
+    
+    async def wait_connected(self):
+        await self.connected_event.wait()
+    
+    async def connect(self):
+        """Одна попытка подключения; повторяет их supervise()"""
+        if not self.has_credentials():
+            return False
+        
+        self.attempts += 1
+        try:
+            if self.client is None:
+                from telethon import TelegramClient as TGClient
+                from telethon.sessions import StringSession
+                
+                # FloodWait обрабатывает наш планировщик, Telethon не должен молча спать сам
+                self.client = TGClient(
+                    StringSession(self.session_string),
+                    int(self.api_id),
+                    self.api_hash,
+                    flood_sleep_threshold=0
+                )
+            # Тот же объект клиента при переподключении: подписки на события сохраняются
+            await self.client.start()
+            self.set_connected(True)
+            self.last_error = None
+            logger.info("✅ Telegram client connected successfully!")
+            return True
+        except Exception as e:
+            logger.error(f"❌ Failed to connect to Telegram: {e}")
+            self.last_error = str(e)
+            self.set_connected(False)
+            return False
+    
+    def start_supervisor(self):
+        self.supervisor = asyncio.create_task(self.supervise())
+    
+    async def supervise(self):
+        """Держит подключение: проверяет его и переподключается с экспоненциальной задержкой"""
+        delay = RECONNECT_MIN_DELAY
+        while True:
+            if self.is_alive():
+                await asyncio.sleep(CONNECTION_CHECK_INTERVAL)
+                continue
+            if not self.has_credentials():
+                if not self.connected:
+                    logger.warning("❌ Telegram credentials not found - using demo mode")
+                    return
+                await asyncio.sleep(CONNECTION_CHECK_INTERVAL)
+                continue
+            
+            if self.connected:
+                logger.warning("🔌 Telegram connection lost, reconnecting")
+                self.set_connected(False)
+                self.reconnects += 1
+            if await self.connect():
+                delay = RECONNECT_MIN_DELAY
+                self.next_attempt_at = None
+                continue
+            
+            # Jitter, чтобы несколько процессов не переподключались синхронно
+            wait = delay * random.uniform(0.8, 1.2)
+            self.next_attempt_at = time.time() + wait
+            logger.info(f"🔁 Next Telegram connection attempt in {wait:.1f}s")
+            await asyncio.sleep(wait)
+            delay = min(delay * 2, RECONNECT_MAX_DELAY)
+    
+    def stats(self):
+        return {
+            "state": self.state(),
+            "attempts": self.attempts,
+            "reconnects": self.reconnects,
+            "last_error": self.last_error,
+            "next_attempt_in": round(self.next_attempt_at - time.time(), 1) if self.next_attempt_at else None
+        }
+    
+    async def resolve_entity(self, channel_username: str, priority: int = INTERACTIVE):
+        """Input peer канала: из кэша, а get_entity только при промахе"""
+        peer = entity_cache.get(channel_username)
+        if peer is not None:
+            return peer
+        
+        entity = await rpc_scheduler.call(
+            "get_entity", lambda: self.client.get_entity(channel_username), priority
+        )
+        logger.info(f"✅ Resolved channel: {entity.title}")
+        entity_cache.set(channel_username, entity)
+        return entity
+    
+    async def get_channel_posts(self, channel_username: str, limit: int = 10, priority: int = INTERACTIVE):
+        """Получение реальных постов из канала
+        
+        Демо-посты только без подключения к Telegram; ошибки Telegram
+        пробрасываются, чтобы не подменять реальные данные фейковыми.
+        """
+        # Подключением занимается supervise(): запрос пользователя его не ждет
+        if not self.connected or not self.client:
+            logger.warning(f"📱 Telegram not connected, using demo for {channel_username}")
+            return self._get_demo_posts(channel_username, limit)
+        
+        try:
+            logger.info(f"🔍 Fetching real posts from {channel_username}")
+            entity = await self.resolve_entity(channel_username, priority)
+            messages = await rpc_scheduler.call(
+                "iter_messages",
+                lambda: collect(self.client.iter_messages(entity, limit=limit*3)),
+                priority
+            )
+        except Exception as e:
+            logger.error(f"❌ Error getting posts from {channel_username}: {e}")
+            if is_stale_peer_error(e):
+                # Peer устарел (канал переименован или закрыт) - резолвим заново
+                entity_cache.invalidate(channel_username)
+            raise
+        
+        posts = []
+        for message in messages:
+            if message.views and message.views >= MIN_VIEWS:
+                posts.append(post_from_row(message_row(channel_username, message)))
+                logger.debug(f"📄 Found post {message.id} with {message.views} views")
+                
+                if len(posts) >= limit:
+                    break
+        
+        logger.info(f"✅ Retrieved {len(posts)} real posts from {channel_username}")
+        return posts
+    
+    def _get_demo_posts(self, channel_username: str, limit: int):
+        """Демо данные как fallback"""
+        logger.info(f"🎭 Generating demo posts for {channel_username}")
+        demo_fallbacks.inc(kind="feed")
+        posts = []
+        
+        demo_images = [
+            "https://images.unsplash.com/photo-1441986300917-64674bd600d8?w=400&h=600&fit=crop",
+            "https://images.unsplash.com/photo-1469334031218-e382a71b716b?w=400&h=600&fit=crop", 
+            "https://images.unsplash.com/photo-1445205170230-053b83016050?w=400&h=600&fit=crop"
+        ]
+        
+        for i in range(min(limit, 3)):
+            post_data = {
+                'id': f"{channel_username}_demo_{i+1}",
+                'channel': channel_username,
+                'message_id': i+1,
+                'category': CHANNEL_CATEGORIES.get(channel_username, ""),
+                'media_type': "photo",
+                'text': f"Demo post from {channel_username} #{i+1} - testing interface",
+                'views': 15000 - i*1000,
+                'likes': 750 - i*50,
+                'comments': 150 - i*10,
+                'date': (datetime.now() - timedelta(hours=i)).isoformat(),
+                'media_url': demo_images[i % len(demo_images)],
+                'post_url': f"https://t.me/{channel_username}/{i+1}"
+            }
+            posts.append(post_data)
+        return posts
+
+# Создаем экземпляр клиента
+telegram_client = TelegramClient()
+
+class FeedEvents:
+    """Рассылка новых и обновленных постов подписчикам SSE по категориям"""
+    def __init__(self):
+        self._subscribers = {}  # category -> set(asyncio.Queue)
+        self.published = 0
+        self.dropped = 0
+    
+    def subscribe(self, category: str):
+        queue = asyncio.Queue(maxsize=100)
+        self._subscribers.setdefault(category, set()).add(queue)
+        return queue
+    
+    def unsubscribe(self, category: str, queue):
+        self._subscribers.get(category, set()).discard(queue)
+    
+    def has_subscribers(self, category: str):
+        return bool(self._subscribers.get(category))
+    
+    def publish(self, category: str, post):
+        for queue in self._subscribers.get(category, ()):
+            try:
+                queue.put_nowait(post)
+                self.published += 1
+            except asyncio.QueueFull:
+                # Медленный клиент не должен тормозить остальных
+                self.dropped += 1
+    
+    def stats(self):
+        return {
+            "subscribers": {category: len(queues) for category, queues in self._subscribers.items()},
+            "published": self.published,
+            "dropped": self.dropped
+        }
+
+feed_events = FeedEvents()
+
+def publish_posts(channel: str, rows):
+    category = CHANNEL_CATEGORIES.get(channel)
+    for row in rows:
+        feed_events.publish(category, post_from_row(row))
+
+class RefreshPlanner:
+    """Адаптивное расписание фонового опроса каналов
+    
+    Интервал опроса - время, за которое канал в среднем публикует один пост
+    (по датам постов за POST_RATE_WINDOW);
+    интервал обновления счетчиков - время, за которое просмотры свежих постов
+    вырастают на VIEW_REFRESH_STEP. Если сумма запросов превышает
+    INGEST_RPC_BUDGET, все интервалы растягиваются в одну и ту же пропорцию.
+    Пока есть фото без хэша, доля бюджета DEDUP_RPC_SHARE отдается задаче
+    dedup, и пачки хэширования идут не чаще, чем она позволяет.
+    Канал, у которого за один опрос не забрали все новые сообщения, опрашивается
+    снова через MIN_POLL_INTERVAL, пока не догонит.
+    """
+    def __init__(self, index: PostIndex):
+        self.index = index
+        self.retry_at = {}  # channel -> время, раньше которого канал после ошибки не трогаем
+        self.behind = set()  # каналы, где после max_id остались незабранные сообщения
+        self.scale = 1.0
+        self.demand = 0.0
+        self.dedup_pending = False
+        self.dedup_at = 0.0
+    
+    @staticmethod
+    def intervals(state):
+        """Базовые (poll, refresh) интервалы канала в секундах до учета бюджета"""
+        if state is None or state['post_rate'] is None:
+            poll = INGEST_INTERVAL
+        else:
+            poll = 3600 / max(state['post_rate'], 1e-6)
+        if state is None or state['view_growth'] is None:
+            refresh = COUNTS_REFRESH_INTERVAL
+        else:
+            refresh = 3600 * VIEW_REFRESH_STEP / max(state['view_growth'], 1e-6)
+        return (
+            min(MAX_POLL_INTERVAL, max(MIN_POLL_INTERVAL, poll)),
+            min(MAX_REFRESH_INTERVAL, max(MIN_REFRESH_INTERVAL, refresh))
+        )
+    
+    def plan(self):
+        """Список задач (due, kind, channel) для всех каналов с учетом бюджета"""
+        states = self.index.channel_states()
+        channels = list(CHANNEL_CATEGORIES)
+        intervals = {ch: self.intervals(states.get(ch)) for ch in channels}
+        
+        # Запросов в минуту при базовых интервалах; не влезаем в бюджет - растягиваем всех
+        self.dedup_pending = self.index.has_unhashed_photos()
+        budget = INGEST_RPC_BUDGET * (1 - DEDUP_RPC_SHARE) if self.dedup_pending else INGEST_RPC_BUDGET
+        self.demand = sum(60 / poll + 60 / refresh for poll, refresh in intervals.values())
+        self.scale = max(1.0, self.demand / budget)
+        
+        tasks = [(self.dedup_at, "dedup", "")] if self.dedup_pending else []
+        for ch in channels:
+            state = states.get(ch)
+            poll, refresh = intervals[ch]
+            not_before = self.retry_at.get(ch, 0)
+            polled_at = state['polled_at'] if state else None
+            if ch in self.behind:
+                poll = MIN_POLL_INTERVAL
+            tasks.append((max(not_before, (polled_at or 0) + poll * self.scale), "poll", ch))
+            if polled_at:
+                refreshed_at = state['refreshed_at'] or 0
+                tasks.append((max(not_before, refreshed_at + refresh * self.scale), "refresh", ch))
+        return tasks
+    
+    def dedup_done(self, rpcs: int):
+        """Следующая пачка хэширования - когда потраченные RPC уложатся в долю бюджета"""
+        self.dedup_at = time.time() + max(rpcs, 1) * 60 / (INGEST_RPC_BUDGET * DEDUP_RPC_SHARE)
+    
+    def stats(self):
+        now = time.time()
+        states = self.index.channel_states()
+        channels = {}
+        for ch in CHANNEL_CATEGORIES:
+            state = states.get(ch)
+            poll, refresh = self.intervals(state)
+            polled_at = state['polled_at'] if state else None
+            channels[ch] = {
+                "poll_interval": round(poll * self.scale),
+                "refresh_interval": round(refresh * self.scale),
+                "post_rate_per_hour": round(state['post_rate'], 3) if state and state['post_rate'] is not None else None,
+                "view_growth_per_hour": round(state['view_growth']) if state and state['view_growth'] is not None else None,
+                "since_poll": round(now - polled_at) if polled_at else None,
+                # Насколько опрос канала запаздывает относительно расписания
+                "lag": round(max(0.0, now - polled_at - poll * self.scale)) if polled_at else None
+            }
+        return {
+            "budget_per_minute": INGEST_RPC_BUDGET,
+            "demand_per_minute": round(self.demand, 2),
+            "scale": round(self.scale, 3),
+            "dedup_pending": self.dedup_pending,
+            "channels": channels
+        }
+
+class Ingester:
+    """Фоновая инкрементальная загрузка постов всех каналов в индекс"""
+    def __init__(self, index: PostIndex):
+        self.index = index
+        self.planner = RefreshPlanner(index)
+        self.task = None
+    
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+    
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+    
+    async def run(self):
+        if not telegram_client.connected and not telegram_client.has_credentials():
+            logger.warning("📭 Ingester disabled - Telegram is not configured")
+            return
+        
+        await telegram_client.wait_connected()
+        self.subscribe_updates()
+        while True:
+            # Пока supervise() переподключается, RPC все равно упадут - ждем
+            await telegram_client.wait_connected()
+            load_channels()
+            tasks = self.planner.plan()
+            if not tasks:
+                await asyncio.sleep(INGEST_INTERVAL)
+                continue
+            
+            due, kind, channel = min(tasks)
+            wait = due - time.time()
+            if wait > 0:
+                # Спим кусками, чтобы подхватывать новые каналы из конфига
+                await asyncio.sleep(min(wait, 5))
+                continue
+            
+            if kind == "dedup":
+                self.planner.dedup_done(await self.hash_photos())
+                continue
+            try:
+                if kind == "poll":
+                    await self.ingest_new(channel)
+                else:
+                    await self.refresh_counts(channel)
+                self.planner.retry_at.pop(channel, None)
+            except Exception as e:
+                logger.error(f"❌ Ingest failed for {channel}: {e}")
+                if is_stale_peer_error(e):
+                    entity_cache.invalidate(channel)
+                self.planner.retry_at[channel] = time.time() + MIN_POLL_INTERVAL
+    
+    async def ingest_new(self, channel: str):
+        """Забирает только сообщения новее сохраненного max_id
+        
+        Первая загрузка берет последние INGEST_MAX_MESSAGES постов. Дальше идем
+        от max_id по возрастанию: если новых больше лимита, следующий опрос
+        продолжит с того же места, а не перепрыгнет через разрыв.
+        """
+        state = self.index.channel_state(channel)
+        max_id = state['max_id'] if state else 0
+        entity = await telegram_client.resolve_entity(channel, BACKGROUND)
+        messages = await rpc_scheduler.call(
+            "iter_messages",
+            lambda: collect(telegram_client.client.iter_messages(
+                entity, min_id=max_id, reverse=bool(max_id), limit=INGEST_MAX_MESSAGES
+            )),
+            BACKGROUND
+        )
+        if max_id and len(messages) >= INGEST_MAX_MESSAGES:
+            self.planner.behind.add(channel)
+        else:
+            self.planner.behind.discard(channel)
+        rows = [message_row(channel, message) for message in messages]
+        
+        if rows:
+            # Первичную загрузку истории и уже пришедшие через события посты подписчикам не рассылаем
+            known = self.index.views(channel, [row['message_id'] for row in rows]) if max_id else None
+            self.index.upsert(rows)
+            await self.hash_inline_thumbs(channel, messages)
+            if max_id:
+                publish_posts(channel, [
+                    row for row in rows if row['views'] >= MIN_VIEWS and row['message_id'] not in known
+                ])
+            max_id = max(row['message_id'] for row in rows)
+            logger.info(f"📥 Ingested {len(rows)} new messages from {channel}")
+        self.index.mark_polled(channel, max_id, self.index.post_rate(channel, POST_RATE_WINDOW))
+    
+    async def refresh_counts(self, channel: str):
+        """Обновляет просмотры, реакции и комментарии свежих постов"""
+        state = self.index.channel_state(channel)
+        view_growth = None
+        ids = self.index.recent_ids(channel, COUNTS_REFRESH_POSTS)
+        if ids:
+            entity = await telegram_client.resolve_entity(channel, BACKGROUND)
+            messages = await rpc_scheduler.call(
+                "get_messages", lambda: telegram_client.client.get_messages(entity, ids=ids), BACKGROUND
+            )
+            rows = [message_row(channel, m) for m in messages if m]
+            old_views = self.index.views(channel, ids)
+            self.index.upsert(rows)
+            # Посты, только что набравшие порог просмотров, появляются в ленте у открытых страниц
+            publish_posts(channel, [
+                row for row in rows
+                if row['views'] >= MIN_VIEWS > old_views.get(row['message_id'], 0)
+            ])
+            
+            # Скорость роста просмотров свежих постов: EWMA просмотров в час
+            if state['refreshed_at']:
+                hours = max(time.time() - state['refreshed_at'], 1) / 3600
+                growth = sum(max(0, row['views'] - old_views.get(row['message_id'], row['views'])) for row in rows)
+                sample = growth / hours
+                view_growth = sample if state['view_growth'] is None else 0.7 * state['view_growth'] + 0.3 * sample
+        self.index.mark_refreshed(channel, view_growth)
+    
+    async def on_message(self, event):
+        """Новое или отредактированное сообщение канала из обновлений Telegram"""
+        message = event.message
+        channel = entity_cache.username_for(getattr(message.peer_id, "channel_id", None))
+        if channel is None:
+            return
+        
+        row = message_row(channel, message)
+        self.index.upsert([row])
+        await self.hash_inline_thumbs(channel, [message])
+        if row['views'] >= MIN_VIEWS:
+            publish_posts(channel, [row])
+    
+    async def hash_inline_thumbs(self, channel: str, messages):
+        """Дедупликация фото, у которых миниатюра пришла вместе с сообщением"""
+        items = []
+        for message in messages:
+            thumb = photo_thumb(message) if message.photo else None
+            if thumb:
+                items.append((channel, message.id, thumb))
+        await photo_dedup.add_thumbs(items)
+    
+    async def hash_photos(self):
+        """Хэширует пачку фото без встроенной миниатюры, качая самую маленькую; возвращает число RPC"""
+        pending = self.index.unhashed_photos(DEDUP_BATCH)
+        by_channel = {}
+        for row in pending:
+            by_channel.setdefault(row['channel'], []).append(row['message_id'])
+        
+        from telethon.errors import FloodWaitError
+        
+        rpcs = 0
+        for channel, ids in by_channel.items():
+            # Без миниатюры пост становится своим отдельным кластером и больше не ждет хэша:
+            # ошибка одного канала или сообщения не должна возвращать всю пачку в очередь
+            thumbs = dict.fromkeys(ids)
+            try:
+                entity = await telegram_client.resolve_entity(channel, BACKGROUND)
+                rpcs += 1
+                messages = await rpc_scheduler.call(
+                    "get_messages", lambda: telegram_client.client.get_messages(entity, ids=ids), BACKGROUND
+                )
+                for message_id, message in zip(ids, messages):
+                    if not message or not message.photo:
+                        continue
+                    thumbs[message_id] = photo_thumb(message)
+                    if thumbs[message_id] is None:
+                        rpcs += 1
+                        try:
+                            thumbs[message_id] = await rpc_scheduler.call(
+                                "download_media",
+                                lambda: telegram_client.client.download_media(message, file=bytes, thumb=0),
+                                BACKGROUND
+                            )
+                        except FloodWaitError:
+                            raise
+                        except Exception as e:
+                            logger.error(f"❌ Photo dedup failed for {channel}/{message_id}: {e}")
+            except FloodWaitError as e:
+                # Временная пауза: необработанные посты остаются в очереди до следующей пачки
+                logger.warning(f"🌊 Photo dedup paused by FloodWait {e.seconds}s")
+                break
+            except Exception as e:
+                logger.error(f"❌ Photo dedup failed for {channel}: {e}")
+                if is_stale_peer_error(e):
+                    entity_cache.invalidate(channel)
+            await photo_dedup.add_thumbs([(channel, message_id, thumb) for message_id, thumb in thumbs.items()])
+        return rpcs
+    
+    def subscribe_updates(self):
+        """Подписка на NewMessage и MessageEdited; каналы фильтруются по peer id в on_message"""
+        from telethon import events
+        
+        telegram_client.client.add_event_handler(self.on_message, events.NewMessage())
+        telegram_client.client.add_event_handler(self.on_message, events.MessageEdited())
+
+ingester = Ingester(post_index)
+
+_fetcher_client = None
+_fetcher_events_client = None
+
+def fetcher_client():
+    """HTTP-клиент к фетчеру через Unix-сокет, один на процесс"""
+    global _fetcher_client
+    if _fetcher_client is None:
+        import httpx
+        _fetcher_client = httpx.AsyncClient(
+            transport=httpx.AsyncHTTPTransport(uds=FETCHER_SOCKET),
+            base_url="http://fetcher",
+            timeout=CHANNEL_TIMEOUT * 2,
+            limits=httpx.Limits(max_connections=FETCHER_MAX_CONNECTIONS,
+                                max_keepalive_connections=FETCHER_MAX_CONNECTIONS)
+        )
+    return _fetcher_client
+
+def fetcher_events_client():
+    """Отдельный клиент для долгих SSE-подписок: они не должны занимать пул запросов"""
+    global _fetcher_events_client
+    if _fetcher_events_client is None:
+        import httpx
+        _fetcher_events_client = httpx.AsyncClient(
+            transport=httpx.AsyncHTTPTransport(uds=FETCHER_SOCKET),
+            base_url="http://fetcher",
+            timeout=None
+        )
+    return _fetcher_events_client
+
+_loop_heartbeat = time.monotonic()
+
+async def watch_channels():
+    """Подхватывает правки CHANNELS_FILE в любой роли, а не только там, где работает ингестер"""
+    while True:
+        await asyncio.sleep(CHANNELS_RELOAD_INTERVAL)
+        load_channels()
+
+async def monitor_event_loop(interval: float = 0.5):
+    """Меряет, насколько позже срока просыпается цикл событий"""
+    global _loop_heartbeat
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(interval)
+        event_loop_lag.observe(max(0.0, loop.time() - started - interval))
+        _loop_heartbeat = time.monotonic()
+
+@app.middleware("http")
+async def measure_request(request: Request, call_next):
+    started = time.monotonic()
+    status = 500  # необработанное исключение тоже должно попасть в метрику
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        # Шаблон пути роута, а не сам путь, чтобы не плодить метки на каждое фото
+        route = request.scope.get("route")
+        http_request_duration.observe(
+            time.monotonic() - started,
+            route=route.path if route else "unmatched",
+            method=request.method,
+            status=status
+        )
+
+@app.get("/")
+async def root():
+    """Главная страница"""
+    return {"message": "Creative MVP - Telegram Real Data Server", "status": "running"}
+
+class FeedCache:
+    """In-process кэш постов канала: TTL, LRU-вытеснение и stale-while-revalidate"""
+    def __init__(self, ttl: float, max_size: int):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries = OrderedDict()  # key -> (stored_at, posts)
+        self._loading = {}  # key -> asyncio.Task, не больше одной загрузки на ключ
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.version = 0  # растет при каждой записи
+    
+    def get(self, key):
+        """Возвращает (posts, state), где state - hit, stale или miss"""
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None, "miss"
+        
+        self._entries.move_to_end(key)
+        stored_at, posts = entry
+        if time.monotonic() - stored_at < self.ttl:
+            self.hits += 1
+            return posts, "hit"
+        self.stale_hits += 1
+        return posts, "stale"
+    
+    def set(self, key, posts):
+        self.version += 1
+        self._entries[key] = (time.monotonic(), posts)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+    
+    def refresh(self, key, loader):
+        """Запускает загрузку ключа в фоне или возвращает уже идущую"""
+        task = self._loading.get(key)
+        if task is None:
+            task = asyncio.create_task(self._load(key, loader))
+            self._loading[key] = task
+        return task
+    
+    async def load(self, key, loader):
+        """Ждет загрузки ключа; одновременные вызовы делят одну загрузку"""
+        # shield: отмена одного ожидающего не отменяет загрузку для остальных
+        return await asyncio.shield(self.refresh(key, loader))
+    
+    async def _load(self, key, loader):
+        try:
+            posts, status = await loader()
+            # Кэшируем только успешные ответы Telegram
+            if status["status"] == "ok":
+                self.set(key, posts)
+            return posts, status
+        finally:
+            self._loading.pop(key, None)
+    
+    def stats(self):
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "stale_hits": self.stale_hits,
+            "misses": self.misses,
+            "refreshing": len(self._loading)
+        }
+
+feed_cache = FeedCache(FEED_CACHE_TTL, FEED_CACHE_SIZE)
+
+def accepted_encodings(accept_encoding: str):
+    """Кодировки из Accept-Encoding с q > 0"""
+    encodings = set()
+    for part in accept_encoding.lower().split(","):
+        name, _, params = part.strip().partition(";")
+        q = params.strip()[2:] if params.strip().startswith("q=") else "1"
+        try:
+            if float(q) > 0:
+                encodings.add(name.strip())
+        except ValueError:
+            continue
+    return encodings
+
+class EncodedPayload:
+    """JSON-ответ, сериализованный один раз; сжатые варианты считаются при первом запросе и хранятся"""
+    def __init__(self, payload):
+        self.identity = orjson.dumps(payload)
+        self.digest = hashlib.sha256(self.identity).hexdigest()[:32]
+        self._encoded = {}
+    
+    def body(self, encoding: str):
+        if encoding == "identity":
+            return self.identity
+        if encoding not in self._encoded:
+            if encoding == "br":
+                self._encoded[encoding] = brotli.compress(self.identity, quality=5)
+            else:
+                self._encoded[encoding] = gzip.compress(self.identity, compresslevel=6)
+        return self._encoded[encoding]
+    
+    def size(self):
+        return len(self.identity) + sum(len(body) for body in self._encoded.values())
+    
+    def response(self, request: Request):
+        accepted = accepted_encodings(request.headers.get("accept-encoding", ""))
+        encoding = "identity"
+        if brotli is not None and "br" in accepted:
+            encoding = "br"
+        elif "gzip" in accepted:
+            encoding = "gzip"
+        
+        etag = f'"{self.digest}"' if encoding == "identity" else f'"{self.digest}-{encoding}"'
+        headers = {"ETag": etag, "Vary": "Accept-Encoding", "Cache-Control": "no-cache"}
+        if etag in [tag.strip() for tag in request.headers.get("if-none-match", "").split(",")]:
+            return Response(status_code=304, headers=headers)
+        if encoding != "identity":
+            headers["Content-Encoding"] = encoding
+        return Response(self.body(encoding), media_type="application/json", headers=headers)
+
+class FeedResponses:
+    """Готовые ответы ленты по (category, limit), действительные для версии данных"""
+    def __init__(self, ttl: float, max_size: int):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries = OrderedDict()  # key -> (stored_at, version, EncodedPayload)
+        self.hits = 0
+        self.misses = 0
+    
+    def get(self, key, version):
+        entry = self._entries.get(key)
+        if entry is None or entry[1] != version or time.monotonic() - entry[0] >= self.ttl:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return entry[2]
+    
+    def set(self, key, version, payload: EncodedPayload):
+        self._entries[key] = (time.monotonic(), version, payload)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+    
+    def stats(self):
+        return {
+            "size": len(self._entries),
+            "bytes": sum(payload.size() for _, _, payload in self._entries.values()),
+            "hits": self.hits,
+            "misses": self.misses
+        }
+
+feed_responses = FeedResponses(FEED_RESPONSE_TTL, FEED_RESPONSE_CACHE_SIZE)
+
+def feed_data_version(index_version: int = None):
+    """Версия данных ленты: индекс постов, кэш живых загрузок и список каналов"""
+    index_version = post_index.version() if index_version is None else index_version
+    return index_version, feed_cache.version, _channels_mtime
+
+# Общий лимит параллельных запросов к каналам (на все запросы к серверу)
+_fetch_semaphore = asyncio.Semaphore(FETCH_CONCURRENCY)
+
+async def load_channel(channel: str, limit: int):
+    """Загрузка одного канала с дедлайном, возвращает посты и статус"""
+    started = time.monotonic()
+    posts = []
+    
+    async def bounded():
+        # Ожидание слота семафора входит в дедлайн канала
+        async with _fetch_semaphore:
+            return await telegram_client.get_channel_posts(channel, limit=limit)
+    
+    try:
+        posts = await asyncio.wait_for(bounded(), timeout=CHANNEL_TIMEOUT)
+        status = "ok" if telegram_client.connected else "demo"
+    except asyncio.TimeoutError:
+        logger.warning(f"⏱️ Channel {channel} timed out after {CHANNEL_TIMEOUT}s")
+        status = "timeout"
+    except Exception as e:
+        logger.error(f"❌ Error getting posts from {channel}: {e}")
+        status = "error"
+    return posts, {
+        "status": status,
+        "posts": len(posts),
+        "elapsed_ms": round((time.monotonic() - started) * 1000)
+    }
+
+async def fetch_channel(channel: str, limit: int):
+    """Посты канала через кэш: устаревшие отдаем сразу и обновляем в фоне"""
+    key = (channel, limit)
+    posts, state = feed_cache.get(key)
+    
+    if state == "miss":
+        posts, status = await feed_cache.load(key, lambda: load_channel(channel, limit))
+        return posts, {**status, "cache": "miss"}
+    
+    if state == "stale":
+        feed_cache.refresh(key, lambda: load_channel(channel, limit))
+    return posts, {"status": "ok", "posts": len(posts), "elapsed_ms": 0, "cache": state}
+
+async def fetch_channels(channels, per_channel: int):
+    """Параллельная загрузка списка каналов"""
+    results = await asyncio.gather(*(fetch_channel(ch, per_channel) for ch in channels))
+    
+    all_posts = []
+    statuses = {}
+    for channel, (posts, status) in zip(channels, results):
+        all_posts.extend(posts)
+        statuses[channel] = status
+    return all_posts, statuses
+
+def per_channel_limit(limit: int, channels):
+    """Сколько постов живой загрузкой просить у каждого канала, чтобы набрать limit"""
+    return max(1, math.ceil(limit / len(channels)))
+
+def cache_state(statuses):
+    """Общий статус кэша ответа: miss, если хоть один канал грузился, затем stale (index считается hit)"""
+    states = {status["cache"] for status in statuses.values()}
+    for state in ("miss", "stale"):
+        if state in states:
+            return state
+    return "hit"
+
+_background_tasks = []
+_warmup_task = None
+_warmup_report = None
+
+async def warm_up():
+    """Резолв всех каналов и прогрев ленты каждой категории, пока сервер еще не принимает запросы"""
+    global _warmup_report
+    if not telegram_client.connected and not telegram_client.has_credentials():
+        return
+    await telegram_client.wait_connected()
+    
+    started = time.monotonic()
+    channels = [ch for category_channels in REAL_CHANNELS.values() for ch in category_channels]
+    resolved = await asyncio.gather(
+        *(telegram_client.resolve_entity(ch) for ch in channels), return_exceptions=True
+    )
+    
+    async def warm_category(category_channels):
+        indexed = [ch for ch in category_channels if post_index.channel_state(ch)]
+        cold = [ch for ch in category_channels if ch not in indexed]
+        if indexed:
+            await feed_ranker.pool(indexed)
+        if cold:
+            await fetch_channels(cold, per_channel_limit(FEED_PAGE_SIZE, category_channels))
+    
+    await asyncio.gather(*(warm_category(category_channels) for category_channels in REAL_CHANNELS.values()))
+    _warmup_report = {
+        "channels": len(channels),
+        "unresolved": [ch for ch, result in zip(channels, resolved) if isinstance(result, Exception)],
+        "elapsed_ms": round((time.monotonic() - started) * 1000)
+    }
+    logger.info(f"🔥 Warmed up {len(REAL_CHANNELS)} categories in {_warmup_report['elapsed_ms']}ms")
+
+async def startup():
+    """Подключение к Telegram и прогрев до того, как uvicorn начнет принимать запросы"""
+    global _warmup_task
+    _background_tasks.append(asyncio.create_task(monitor_event_loop()))
+    _background_tasks.append(asyncio.create_task(watch_channels()))
+    if APP_ROLE == "web":
+        return
+    
+    telegram_client.start_supervisor()
+    _warmup_task = asyncio.create_task(warm_up())
+    try:
+        # shield: по таймауту старт продолжается, а прогрев доделывается в фоне
+        await asyncio.wait_for(asyncio.shield(_warmup_task), STARTUP_TIMEOUT)
+    except asyncio.TimeoutError:
+        logger.warning(f"⏱️ Telegram is not ready after {STARTUP_TIMEOUT}s, starting without warm-up")
+    except Exception as e:
+        logger.error(f"❌ Warm-up failed: {e}")
+    ingester.start()
+
+async def shutdown():
+    await ingester.stop()
+    for task in (telegram_client.supervisor, _warmup_task, *_background_tasks):
+        if task:
+            task.cancel()
+    if telegram_client.client and telegram_client.connected:
+        await telegram_client.client.disconnect()
+    upstream = list(_upstream_events.values())
+    for task in upstream:
+        task.cancel()
+    # Подписки закрывают свои потоки сами, до закрытия клиента
+    await asyncio.gather(*upstream, return_exceptions=True)
+    for client in (_fetcher_client, _fetcher_events_client):
+        if client is not None:
+            await client.aclose()
+
+@app.get("/health/live")
+async def health_live():
+    """Liveness: цикл событий не завис, супервизор подключения не упал"""
+    heartbeat_age = time.monotonic() - _loop_heartbeat
+    supervisor = telegram_client.supervisor
+    supervisor_failed = (supervisor is not None and supervisor.done()
+                         and not supervisor.cancelled() and supervisor.exception() is not None)
+    alive = heartbeat_age < LIVENESS_MAX_LAG and not supervisor_failed
+    return JSONResponse(
+        {"status": "ok" if alive else "fail", "heartbeat_age": round(heartbeat_age, 3),
+         "supervisor_failed": supervisor_failed},
+        status_code=200 if alive else 503
+    )
+
+@app.get("/health/ready")
+async def health_ready():
+    """Readiness: прогрев закончен и Telegram подключен (или не настроен - тогда демо-режим)"""
+    if APP_ROLE == "web":
+        # Реальные данные web-воркеру дает фетчер - готовность его
+        try:
+            response = await fetcher_client().get("/health/ready", timeout=2)
+            ready, fetcher = response.status_code == 200, response.json()
+        except Exception as e:
+            ready, fetcher = False, {"error": str(e)}
+        return JSONResponse({"status": "ready" if ready else "not_ready", "fetcher": fetcher},
+                            status_code=200 if ready else 503)
+    
+    warmed = _warmup_task is not None and _warmup_task.done()
+    ready = warmed and telegram_client.state() != "disconnected"
+    return JSONResponse(
+        {"status": "ready" if ready else "not_ready", "warmed": warmed, "warmup": _warmup_report,
+         "telegram": telegram_client.stats()},
+        status_code=200 if ready else 503
+    )
+
+@app.get("/stats")
+async def stats():
+    """Статистика кэшей"""
+    return {
+        "telegram": telegram_client.stats(),
+        "feed_cache": feed_cache.stats(),
+        "feed_responses": feed_responses.stats(),
+        "entities": entity_cache.stats(),
+        "photo_cache": photo_cache.stats(),
+        "post_index": post_index.stats(),
+        "photo_flight": photo_flight.stats(),
+        "message_batcher": message_batcher.stats(),
+        "scheduler": rpc_scheduler.stats(),
+        "feed_events": feed_events.stats(),
+        "refresh": ingester.planner.stats(),
+        "dedup": photo_dedup.stats(),
+        "features": feature_store.stats(),
+        "ranking": feed_ranker.stats()
+    }
 
-# Настройка логирования
-logging.basicConfig(level=logging.INFO)
-logger = logging.getLogger(__name__)
+@app.get("/metrics")
+async def metrics():
+    """Метрики в формате Prometheus"""
+    cache_hits = Counter("cache_hits_total", "Cache hits by cache")
+    cache_misses = Counter("cache_misses_total", "Cache misses by cache")
+    for name, cache in (("feed", feed_cache), ("feed_response", feed_responses), ("entity", entity_cache),
+                        ("photo", photo_cache)):
+        cache_hits.set(cache.hits, cache=name)
+        cache_misses.set(cache.misses, cache=name)
+    cache_hits.set(feed_cache.stale_hits, cache="feed_stale")
+    
+    queue_depth = Gauge("telegram_rpc_queue_depth", "Telegram RPC calls waiting in the scheduler")
+    for method, method_stats in rpc_scheduler.stats().items():
+        queue_depth.set(method_stats["queued"], method=method)
+    
+    refresh_lag = Gauge("ingest_channel_lag_seconds", "How far behind schedule the last poll of a channel is")
+    for channel, channel_stats in ingester.planner.stats()["channels"].items():
+        if channel_stats["lag"] is not None:
+            refresh_lag.set(channel_stats["lag"], channel=channel)
+    
+    lines = []
+    for metric in (http_request_duration, telegram_rpc_duration, telegram_rpc_errors, demo_fallbacks,
+                   photo_bytes_served, event_loop_lag, feed_rank_duration, cache_hits, cache_misses, queue_depth, refresh_lag):
+        lines += metric.render()
+    return Response("\n".join(lines) + "\n", media_type="text/plain; version=0.0.4")
 
-app = FastAPI(title="Creative MVP - Telegram Real Data Server")
+def encode_cursor(post, as_of: float):
+    """Непрозрачный курсор страницы: позиция (score, id) последнего поста и момент ранжирования"""
+    payload = json.dumps({"s": post['score'], "id": post['id'], "t": as_of}, separators=(",", ":"))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip("=")
 
-# Модели данных
-class FeedItem(BaseModel):
-    id: str
-    category: str
-    media_type: str
-    text: str
-    views: int
-    likes: int
-    comments: int
-    date: str
-    media_url: str
-    post_url: str
+def decode_cursor(cursor: str):
+    """(as_of, (score, id)) из курсора; битый курсор - 400"""
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        return float(payload["t"]), (float(payload["s"]), str(payload["id"]))
+    except Exception:
+        raise HTTPException(400, "Invalid cursor")
 
-class PromptReq(BaseModel):
-    feed_item_id: str
+def index_statuses(candidates: Candidates, channels):
+    counts = dict(zip(candidates.channel_names, np.bincount(candidates.channel_codes).tolist()))
+    return {
+        ch: {"status": "ok", "posts": counts.get(ch, 0), "elapsed_ms": 0, "cache": "index"}
+        for ch in channels
+    }
 
-# Реальные рабочие каналы (только проверенные)
-REAL_CHANNELS = {
-    "fashion": ["rogov24", "burimovasasha", "zarina_brand"],
-    "beauty": ["goldapple_ru", "glamguruu"],
-    "home": ["casacozy", "homiesapiens"]
-}
+async def fetch_channel_named(channel: str, limit: int):
+    posts, status = await fetch_channel(channel, limit)
+    return channel, posts, status
 
-# Telegram клиент
-class TelegramClient:
-    def __init__(self):
-        self.api_id = os.getenv("TELEGRAM_API_ID")
-        self.api_hash = os.getenv("TELEGRAM_API_HASH")
-        self.session_string = os.getenv("TELEGRAM_SESSION")
-        self.client = None
-        self.connected = False
-        self.connection_attempted = False
-        
-    async def connect(self):
-        """Подключение к Telegram"""
-        if self.connection_attempted:
-            return self.connected
-            
-        self.connection_attempted = True
-        
-        if not all([self.api_id, self.api_hash, self.session_string]):
-            logger.warning("❌ Telegram credentials not found - using demo mode")
-            return False
-            
+async def stream_feed(category: str, indexed, cold, failed, limit: int, per_channel: int, as_of: float, after):
+    """NDJSON: строка на индекс и на каждый живой канал по мере ответа, затем итог
+    
+    Посты каждой строки уже отсортированы; текущий top-limit сливается с
+    новой пачкой k-way merge, в поток уходят только вошедшие в него посты.
+    """
+    merged = []
+    statuses = dict(failed)
+    total = 0
+    
+    def batch(batch_statuses, candidates):
+        nonlocal merged, total
+        posts = feed_ranker.rank(candidates, limit, as_of, after)
+        merged = list(itertools.islice(heapq.merge(merged, posts, key=feed_order), limit))
+        kept = {post['id'] for post in merged}
+        statuses.update(batch_statuses)
+        total += len(candidates)
+        line = {
+            "channels": batch_statuses,
+            "posts": feed_items.dump_python(feed_items.validate_python([post for post in posts if post['id'] in kept]))
+        }
+        return orjson.dumps(line) + b"\n"
+    
+    if failed:
+        yield orjson.dumps({"channels": failed, "posts": []}) + b"\n"
+    if indexed:
+        candidates = await feed_ranker.pool(indexed)
+        yield batch(index_statuses(candidates, indexed), candidates)
+    for loaded in asyncio.as_completed([fetch_channel_named(ch, per_channel) for ch in cold]):
+        channel, posts, status = await loaded
+        yield batch({channel: status}, Candidates.from_posts(posts))
+    
+    # Живые каналы отдают только первые per_channel постов - продолжения у такой страницы нет
+    next_cursor = encode_cursor(merged[-1], as_of) if merged and len(merged) == limit and not cold else None
+    yield orjson.dumps({
+        "done": True,
+        "category": category,
+        "total": total,
+        "cache": cache_state(statuses) if statuses else "hit",
+        "next_cursor": next_cursor
+    }) + b"\n"
+
+@app.get("/telegram/channels/{category}")
+async def get_channel_posts(category: str, request: Request,
+                            limit: int = Query(FEED_PAGE_SIZE, ge=1, le=FEED_MAX_LIMIT), cursor: str = None,
+                            stream: bool = False):
+    """Лента категории с пагинацией по курсору
+    
+    stream=1 (или Accept: application/x-ndjson) - NDJSON-поток, в котором
+    посты приходят по мере ответа каналов.
+    """
+    logger.info(f"📱 Getting posts for category: {category}")
+    
+    if category not in REAL_CHANNELS:
+        return {"error": "Invalid category", "posts": []}
+    
+    stream = stream or "application/x-ndjson" in request.headers.get("accept", "")
+    as_of, after = decode_cursor(cursor) if cursor else (time.time(), None)
+    channels = REAL_CHANNELS[category]
+    per_channel = per_channel_limit(limit, channels)
+    
+    # Каналы, уже загруженные в индекс, отдаем из него; остальные - живым запросом
+    indexed = [ch for ch in channels if post_index.channel_state(ch)]
+    cold = [ch for ch in channels if ch not in indexed]
+    
+    key = (category, limit)
+    version = feed_data_version()
+    if not cursor and not stream:
+        payload = feed_responses.get(key, version)
+        if payload is not None:
+            return payload.response(request)
+    
+    if cold and APP_ROLE == "web":
+        # Непроиндексированные каналы умеет грузить только фетчер
+        params = {"limit": limit, **({"cursor": cursor} if cursor else {})}
         try:
-            from telethon import TelegramClient as TGClient
-            from telethon.sessions import StringSession
-            
-            self.client = TGClient(
-                StringSession(self.session_string),
-                int(self.api_id),
-                self.api_hash
-            )
-            await self.client.start()
-            self.connected = True
-            logger.info("✅ Telegram client connected successfully!")
-            return True
+            client = fetcher_client()
+            if stream:
+                response = await client.send(
+                    client.build_request("GET", f"/telegram/channels/{category}", params={**params, "stream": 1}),
+                    stream=True
+                )
+                response.raise_for_status()
+                
+                async def relay():
+                    try:
+                        async for chunk in response.aiter_raw():
+                            yield chunk
+                    finally:
+                        await response.aclose()
+                return StreamingResponse(relay(), media_type="application/x-ndjson")
+            response = await client.get(f"/telegram/channels/{category}", params=params)
+            response.raise_for_status()
+            return response.json()
         except Exception as e:
-            logger.error(f"❌ Failed to connect to Telegram: {e}")
-            self.connected = False
-            return False
+            logger.error(f"❌ Fetcher is unavailable: {e}")
+            failed = {ch: {"status": "error", "posts": 0, "elapsed_ms": 0, "cache": "miss"} for ch in cold}
+            cold = []
+    else:
+        failed = {}
     
-    async def get_channel_posts(self, channel_username: str, limit: int = 10):
-        """Получение реальных постов из канала"""
-        # Сначала пытаемся подключиться
-        if not self.connected:
-            await self.connect()
-        
-        if not self.connected or not self.client:
-            logger.warning(f"📱 Telegram not connected, using demo for {channel_username}")
-            return self._get_demo_posts(channel_username, limit)
+    if stream:
+        return StreamingResponse(
+            stream_feed(category, indexed, cold, failed, limit, per_channel, as_of, after),
+            media_type="application/x-ndjson",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+        )
+    
+    candidates = await feed_ranker.pool(indexed) if indexed else Candidates.from_posts([])
+    if indexed:
+        # Пока пул пересобирается, ответ из предыдущего пула кэшируется под его версией
+        version = feed_data_version(candidates.version)
+    statuses = {**index_statuses(candidates, indexed), **failed}
+    if cold:
+        cold_posts, cold_statuses = await fetch_channels(cold, per_channel)
+        candidates = candidates.concat(Candidates.from_posts(cold_posts))
+        statuses.update(cold_statuses)
+    
+    posts = feed_ranker.rank(candidates, limit, as_of, after)
+    # Курсор только для страниц из индекса: живые каналы отдали лишь первые per_channel постов,
+    # вторая страница по ним была бы пустой или дырявой
+    has_more = bool(posts) and len(posts) == limit and not cold
+    
+    logger.info(f"✅ Returning {len(posts)} posts for category {category}")
+    payload = EncodedPayload({
+        "category": category,
+        "posts": feed_items.dump_python(feed_items.validate_python(posts)),
+        "total": len(candidates),
+        "cache": cache_state(statuses),
+        "channels": statuses,
+        "next_cursor": encode_cursor(posts[-1], as_of) if has_more else None
+    })
+    # Кэшируем только первую страницу, собранную целиком из индекса и свежего кэша
+    if not cursor and not failed and cache_state(statuses) == "hit":
+        feed_responses.set(key, version, payload)
+    return payload.response(request)
+
+def photo_response(request: Request, path: str, digest: str, media_type: str = "image/jpeg"):
+    """Фото из кэша с ETag; при совпадении If-None-Match - 304 без тела"""
+    etag = f'"{digest}"'
+    headers = {"ETag": etag, "Cache-Control": PHOTO_CACHE_CONTROL}
+    if_none_match = request.headers.get("if-none-match", "")
+    if etag in [tag.strip() for tag in if_none_match.split(",")] or if_none_match.strip() == "*":
+        return Response(status_code=304, headers=headers)
+    
+    response = FileResponse(path, media_type=media_type, headers=headers)
+    photo_bytes_served.inc(os.path.getsize(path))
+    return response
+
+def placeholder_response():
+    """Локальная заглушка вместо фото, кэшируется браузером ненадолго"""
+    demo_fallbacks.inc(kind="photo")
+    return FileResponse(
+        PLACEHOLDER_PATH,
+        media_type="image/svg+xml",
+        headers={"Cache-Control": "public, max-age=300"}
+    )
+
+def render_variant(path: str, width: int, fmt: str):
+    """Уменьшает фото до ширины width и кодирует в fmt (выполняется в пуле процессов)"""
+    from PIL import Image
+    
+    with Image.open(path) as image:
+        if width and image.width > width:
+            size = (width, max(1, round(image.height * width / image.width)))
+            # draft позволяет JPEG-декодеру сразу читать уменьшенную копию
+            image.draft("RGB", size)
+            image = image.resize(size, Image.LANCZOS)
+        if image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
         
+        buffer = io.BytesIO()
+        image.save(buffer, format=fmt.upper(), quality=PHOTO_QUALITY)
+        return buffer.getvalue()
+
+_image_pool = None
+
+def image_pool():
+    """Пул процессов для Pillow создается при первом использовании"""
+    global _image_pool
+    if _image_pool is None:
+        _image_pool = ProcessPoolExecutor(max_workers=IMAGE_WORKERS)
+    return _image_pool
+
+class SingleFlight:
+    """Одна выполняемая операция на ключ, одновременные вызовы ждут ее результата"""
+    def __init__(self):
+        self._calls = {}  # key -> asyncio.Task
+        self.shared = 0
+    
+    async def do(self, key, factory):
+        task = self._calls.get(key)
+        if task is None:
+            task = asyncio.create_task(factory())
+            self._calls[key] = task
+            task.add_done_callback(lambda _: self._calls.pop(key, None))
+        else:
+            self.shared += 1
+        # shield: отмена одного ожидающего не отменяет операцию для остальных
+        return await asyncio.shield(task)
+    
+    def stats(self):
+        return {"in_flight": len(self._calls), "shared": self.shared}
+
+class MessageBatcher:
+    """Собирает одновременные запросы сообщений канала в один get_messages(ids=[...])"""
+    def __init__(self, window: float):
+        self.window = window
+        self._pending = {}  # channel -> {message_id: asyncio.Future}
+        self.requests = 0
+        self.batches = 0
+    
+    async def get(self, channel: str, message_id: int):
+        self.requests += 1
+        pending = self._pending.get(channel)
+        if pending is None:
+            pending = self._pending[channel] = {}
+            asyncio.get_running_loop().call_later(
+                self.window, lambda: asyncio.create_task(self._flush(channel))
+            )
+        future = pending.get(message_id)
+        if future is None:
+            future = pending[message_id] = asyncio.get_running_loop().create_future()
+        return await asyncio.shield(future)
+    
+    async def _flush(self, channel: str):
+        pending = self._pending.pop(channel)
+        self.batches += 1
         try:
-            logger.info(f"🔍 Fetching real posts from {channel_username}")
-            posts = []
-            
-            # Получаем entity канала
-            try:
-                entity = await self.client.get_entity(channel_username)
-                logger.info(f"✅ Found channel: {entity.title}")
-            except Exception as e:
-                logger.error(f"❌ Channel {channel_username} not found: {e}")
-                return self._get_demo_posts(channel_username, limit)
-            
-            # Получаем сообщения
-            message_count = 0
-            async for message in self.client.iter_messages(entity, limit=limit*3):
-                if message.views and message.views >= 1000:  # Минимум 1000 просмотров
-                    post_data = {
-                        'id': f"{channel_username}_{message.id}",
-                        'channel': channel_username,
-                        'message_id': message.id,
-                        'text': (message.text or "No text")[:200],
-                        'views': message.views or 0,
-                        'likes': getattr(message.reactions, 'count', 0) if message.reactions else 0,
-                        'comments': message.replies.replies if message.replies else 0,
-                        'date': message.date.isoformat(),
-                        'media_url': f"/photo/{channel_username}/{message.id}" if message.photo else "https://images.unsplash.com/photo-1441986300917-64674bd600d8?w=400&h=600&fit=crop",
-                        'post_url': f"https://t.me/{channel_username}/{message.id}"
-                    }
-                    posts.append(post_data)
-                    message_count += 1
-                    logger.info(f"📄 Found post {message.id} with {message.views} views")
-                    
-                    if message_count >= limit:
-                        break
-            
-            logger.info(f"✅ Retrieved {len(posts)} real posts from {channel_username}")
-            return posts
-            
+            entity = await telegram_client.resolve_entity(channel)
+            messages = await rpc_scheduler.call(
+                "get_messages", lambda: telegram_client.client.get_messages(entity, ids=list(pending))
+            )
+            for future, message in zip(pending.values(), messages):
+                future.set_result(message)
         except Exception as e:
-            logger.error(f"❌ Error getting posts from {channel_username}: {e}")
-            return self._get_demo_posts(channel_username, limit)
+            for future in pending.values():
+                future.set_exception(e)
+            # Исключение уже передано ожидающим, здесь его повторно не логируем
+            for future in pending.values():
+                future.exception()
     
-    def _get_demo_posts(self, channel_username: str, limit: int):
-        """Демо данные как fallback"""
-        logger.info(f"🎭 Generating demo posts for {channel_username}")
-        posts = []
-        
-        demo_images = [
-            "https://images.unsplash.com/photo-1441986300917-64674bd600d8?w=400&h=600&fit=crop",
-            "https://images.unsplash.com/photo-1469334031218-e382a71b716b?w=400&h=600&fit=crop", 
-            "https://images.unsplash.com/photo-1445205170230-053b83016050?w=400&h=600&fit=crop"
-        ]
-        
-        for i in range(min(limit, 3)):
-            post_data = {
-                'id': f"{channel_username}_demo_{i+1}",
-                'channel': channel_username,
-                'message_id': i+1,
-                'text': f"Demo post from {channel_username} #{i+1} - testing interface",
-                'views': 15000 - i*1000,
-                'likes': 750 - i*50,
-                'comments': 150 - i*10,
-                'date': (datetime.now() - timedelta(hours=i)).isoformat(),
-                'media_url': demo_images[i % len(demo_images)],
-                'post_url': f"https://t.me/{channel_username}/{i+1}"
-            }
-            posts.append(post_data)
-        return posts
+    def stats(self):
+        return {"requests": self.requests, "batches": self.batches}
 
-# Создаем экземпляр клиента
-telegram_client = TelegramClient()
+photo_flight = SingleFlight()
+message_batcher = MessageBatcher(MESSAGE_BATCH_WINDOW)
 
-@app.get("/")
-async def root():
-    """Главная страница"""
-    return {"message": "Creative MVP - Telegram Real Data Server", "status": "running"}
+async def download_to_file(media, path: str):
+    """Качает файл чанками в path, возвращает (size, sha256)"""
+    digest = hashlib.sha256()
+    size = 0
+    with open(path, "wb") as f:
+        async for chunk in telegram_client.client.iter_download(media):
+            f.write(chunk)
+            digest.update(chunk)
+            size += len(chunk)
+    return size, digest.hexdigest()
 
-@app.get("/telegram/channels/{category}")
-async def get_channel_posts(category: str, limit: int = 25):
-    """Получение постов из канала"""
-    logger.info(f"📱 Getting posts for category: {category}")
+async def download_photo(channel: str, message_id: int, cache_key: str):
+    """Качает фото из Telegram чанками прямо в кэш и возвращает (path, digest)"""
+    message = await message_batcher.get(channel, message_id)
+    if not message or not message.photo:
+        raise HTTPException(404, "Photo not found")
     
-    if category not in REAL_CHANNELS:
-        return {"error": "Invalid category", "posts": []}
+    tmp_path = photo_cache.temp_path()
+    try:
+        size, digest = await rpc_scheduler.call(
+            "download_media", lambda: download_to_file(message.photo, tmp_path)
+        )
+        return photo_cache.commit(cache_key, tmp_path, digest, size)
+    finally:
+        # Загрузка оборвалась - недокачанный файл в кэш не попадает
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+async def render_photo(original_path: str, variant_key: str, width: int, fmt: str):
+    """Рендерит вариант фото в пуле процессов и кладет его в кэш"""
+    data = await asyncio.get_running_loop().run_in_executor(
+        image_pool(), render_variant, original_path, width, fmt
+    )
+    return await asyncio.to_thread(photo_cache.put, variant_key, data)
+
+SSE_KEEPALIVE = 15
+
+_upstream_events = {}  # category -> asyncio.Task подписки web-воркера на фетчер
+
+async def relay_upstream_events(category: str):
+    """Одна подписка на события фетчера на категорию, раздается локальным клиентам через feed_events
     
-    all_posts = []
-    for channel in REAL_CHANNELS[category]:
+    Пока у воркера есть подписчики категории, обрыв переподключается с backoff;
+    без подписчиков задача завершается на ближайшем keepalive.
+    """
+    def unsubscribed():
+        # Снимаемся с учета сразу, без await: новый подписчик заведет новую задачу
+        if feed_events.has_subscribers(category):
+            return False
+        _upstream_events.pop(category, None)
+        return True
+    
+    delay = RECONNECT_MIN_DELAY
+    while not unsubscribed():
         try:
-            posts = await telegram_client.get_channel_posts(
-                channel, 
-                limit=limit//len(REAL_CHANNELS[category])
-            )
-            all_posts.extend(posts)
+            async with fetcher_events_client().stream("GET", f"/events/{category}") as response:
+                response.raise_for_status()
+                delay = RECONNECT_MIN_DELAY
+                event = None
+                async for line in response.aiter_lines():
+                    if unsubscribed():
+                        return
+                    if line.startswith("event: "):
+                        event = line[len("event: "):]
+                    elif line.startswith("data: ") and event == "post":
+                        feed_events.publish(category, json.loads(line[len("data: "):]))
+                    elif not line:
+                        event = None
         except Exception as e:
-            logger.error(f"❌ Error getting posts from {channel}: {e}")
-            continue
+            logger.error(f"❌ Fetcher events for {category} failed: {e}")
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, RECONNECT_MAX_DELAY)
+
+@app.get("/events/{category}")
+async def feed_events_stream(category: str, request: Request):
+    """Server-sent events с новыми и обновленными постами категории"""
+    if category not in REAL_CHANNELS:
+        raise HTTPException(404, "Invalid category")
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
     
-    # Сортируем по просмотрам
-    all_posts.sort(key=lambda x: x['views'], reverse=True)
+    async def stream():
+        queue = feed_events.subscribe(category)
+        if APP_ROLE == "web" and category not in _upstream_events:
+            # События приходят только в фетчер - на все вкладки воркера одна подписка
+            _upstream_events[category] = asyncio.create_task(relay_upstream_events(category))
+        try:
+            yield "retry: 5000\n\n"
+            while not await request.is_disconnected():
+                try:
+                    post = await asyncio.wait_for(queue.get(), SSE_KEEPALIVE)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                yield f"event: post\ndata: {json.dumps(post, ensure_ascii=False)}\n\n"
+        finally:
+            feed_events.unsubscribe(category, queue)
     
-    logger.info(f"✅ Returning {len(all_posts)} posts for category {category}")
-    return {
-        "category": category,
-        "posts": all_posts[:limit],
-        "total": len(all_posts)
-    }
+    return StreamingResponse(stream(), media_type="text/event-stream", headers=headers)
+
+def photo_keys(channel: str, message_id: int, w: int, fmt: str):
+    """Ключи кэша оригинала и варианта (None без w и fmt) и параметры варианта"""
+    cache_key = f"{channel}/{message_id}"
+    if not (w or fmt):
+        return cache_key, None, 0, ""
+    width = next((size for size in PHOTO_WIDTHS if size >= w), PHOTO_WIDTHS[-1]) if w else 0
+    fmt = fmt or "jpeg"
+    return cache_key, f"{cache_key}@{width}.{fmt}", width, fmt
+
+async def fill_photo_cache(channel: str, message_id: int, w: int = 0, fmt: str = ""):
+    """Кладет фото и нужный вариант в кэш через Telegram, возвращает (path, digest) варианта"""
+    cache_key, variant_key, width, fmt = photo_keys(channel, message_id, w, fmt)
+    
+    # Одновременные запросы одного фото ждут одну общую загрузку
+    original = photo_cache.get(cache_key)
+    if not original:
+        original = await photo_flight.do(
+            cache_key, lambda: download_photo(channel, message_id, cache_key)
+        )
+    if not variant_key:
+        return original
+    
+    return await photo_flight.do(
+        variant_key, lambda: render_photo(original[0], variant_key, width, fmt)
+    )
 
 @app.get("/photo/{channel}/{message_id}")
-async def get_photo(channel: str, message_id: int):
-    """Получение реального фото из Telegram"""
+async def get_photo(channel: str, message_id: int, request: Request, w: int = 0, fmt: str = ""):
+    """Получение реального фото из Telegram, опционально уменьшенного (w) и перекодированного (fmt)"""
+    if not re.fullmatch(r"\w{1,64}", channel):
+        raise HTTPException(404, "Photo not found")
+    if fmt and fmt not in PHOTO_FORMATS:
+        raise HTTPException(400, f"Unsupported format, use one of: {', '.join(PHOTO_FORMATS)}")
+    
+    _, variant_key, _, fmt = photo_keys(channel, message_id, w, fmt)
+    media_type = PHOTO_FORMATS[fmt] if variant_key else "image/jpeg"
+    cached = await cached_photo(channel, message_id, w, fmt if variant_key else "")
+    if not cached:
+        return placeholder_response()
+    return photo_response(request, *cached, media_type=media_type)
+
+async def cached_photo(channel: str, message_id: int, w: int = 0, fmt: str = ""):
+    """(path, digest) фото или его варианта: из кэша, иначе через Telegram или фетчер; None, если недоступно"""
+    # Дубликаты одного фото делят копию в кэше: ключ и загрузка - по первому посту кластера
+    source = post_index.photo_source(channel, message_id)
+    cached = await load_photo(*source, w, fmt)
+    if cached is None and source != (channel, message_id):
+        # Пост-источник удален или его канал убран из конфига - берем собственное фото
+        cached = await load_photo(channel, message_id, w, fmt)
+    return cached
+
+async def load_photo(channel: str, message_id: int, w: int = 0, fmt: str = ""):
+    # Кэш проверяем до Telegram: повторные запросы и 304 не тратят RPC
+    cache_key, variant_key, _, fmt = photo_keys(channel, message_id, w, fmt)
+    cached = photo_cache.get(variant_key or cache_key)
+    if cached:
+        return cached
+    
     try:
-        if not telegram_client.connected or not telegram_client.client:
-            # Fallback на демо изображение
-            demo_url = f"https://images.unsplash.com/photo-1441986300917-64674bd600d8?w=400&h=600&fit=crop&seed={channel}_{message_id}"
-            response = requests.get(demo_url)
-            if response.status_code == 200:
-                return StreamingResponse(
-                    io.BytesIO(response.content),
-                    media_type="image/jpeg",
-                    headers={"Cache-Control": "public, max-age=3600"}
-                )
-            else:
-                raise HTTPException(404, "Demo photo not found")
-        
-        # Получаем реальное фото из Telegram
-        entity = await telegram_client.client.get_entity(channel)
-        message = await telegram_client.client.get_messages(entity, ids=message_id)
-        
-        if not message or not message.photo:
-            raise HTTPException(404, "Photo not found")
-        
-        # Скачиваем фото в память
-        photo_bytes = await telegram_client.client.download_media(message.photo, file=bytes)
-        
-        if not photo_bytes:
-            raise HTTPException(404, "Photo download failed")
-        
-        # Возвращаем фото как поток
-        return StreamingResponse(
-            io.BytesIO(photo_bytes),
-            media_type="image/jpeg",
-            headers={"Cache-Control": "public, max-age=3600"}
-        )
-        
+        if APP_ROLE == "web":
+            # Фото качает фетчер, а отдаем его из общего дискового кэша
+            response = await fetcher_client().post(
+                f"/internal/photo/{channel}/{message_id}", params={"w": w, "fmt": fmt if variant_key else ""}
+            )
+            response.raise_for_status()
+            cached = photo_cache.get(variant_key or cache_key)
+        elif telegram_client.connected and telegram_client.client:
+            cached = await fill_photo_cache(channel, message_id, w, fmt if variant_key else "")
     except Exception as e:
         logger.error(f"❌ Error getting photo: {e}")
-        # Fallback на демо изображение
-        demo_url = f"https://images.unsplash.com/photo-1441986300917-64674bd600d8?w=400&h=600&fit=crop&seed={channel}_{message_id}"
-        response = requests.get(demo_url)
-        if response.status_code == 200:
-            return StreamingResponse(
-                io.BytesIO(response.content),
-                media_type="image/jpeg",
-                headers={"Cache-Control": "public, max-age=3600"}
+    return cached
+
+if APP_ROLE == "fetcher":
+    @app.post("/internal/photo/{channel}/{message_id}")
+    async def internal_fill_photo(channel: str, message_id: int, w: int = 0, fmt: str = ""):
+        """Загрузка фото в общий кэш по запросу HTTP-воркера"""
+        if not telegram_client.connected:
+            raise HTTPException(503, "Telegram is not connected")
+        _, digest = await fill_photo_cache(channel, message_id, w, fmt)
+        return {"digest": digest}
+
+HASHTAG_RE = re.compile(r"#(\w+)")
+WORD_RE = re.compile(r"[^\W\d_]{4,}")
+STOP_WORDS = frozenset("""
+    this that with from have your will what when just more about into only also they them their there
+    which been were here very some than then over like post channel
+    это этот эта эти как для что все так его она они или уже при если только когда чтобы есть наш наши
+    ваш ваши вас нас будет можно очень ещё еще себя свой своих также тоже новый новая новые
+""".split())
+
+# Опорные цвета для человекочитаемых имен палитры
+COLOR_NAMES = {
+    "black": (20, 20, 20), "white": (240, 240, 240), "gray": (128, 128, 128), "red": (200, 30, 40),
+    "orange": (235, 130, 40), "yellow": (235, 210, 60), "green": (60, 150, 70), "olive": (120, 120, 50),
+    "teal": (40, 140, 140), "blue": (40, 80, 190), "navy": (25, 35, 90), "purple": (120, 60, 160),
+    "pink": (235, 150, 180), "brown": (110, 70, 40), "beige": (220, 200, 170)
+}
+
+def text_features(text: str):
+    """Хэштеги и ключевые слова подписи: самые частые слова без стоп-слов"""
+    hashtags = list(dict.fromkeys(tag.lower() for tag in HASHTAG_RE.findall(text)))
+    counts = {}
+    for word in WORD_RE.findall(HASHTAG_RE.sub(" ", text)):
+        word = word.lower()
+        if word not in STOP_WORDS:
+            counts[word] = counts.get(word, 0) + 1
+    keywords = sorted(counts, key=lambda word: -counts[word])[:5]
+    return {"hashtags": hashtags[:10], "keywords": keywords}
+
+def color_name(rgb):
+    return min(COLOR_NAMES, key=lambda name: sum((a - b) ** 2 for a, b in zip(COLOR_NAMES[name], rgb)))
+
+def kmeans_palette(pixels, k: int, iterations: int = 12):
+    """Доминирующие цвета: k-means по пикселям (n, 3), все точки и центры за одну операцию на шаг"""
+    unique = np.unique(pixels, axis=0)
+    k = min(k, len(unique))
+    # Детерминированный старт: цвета, равномерно взятые по яркости
+    luminance = unique @ np.array([0.299, 0.587, 0.114], dtype=np.float32)
+    centers = unique[np.argsort(luminance)[np.linspace(0, len(unique) - 1, k).astype(int)]]
+    for _ in range(iterations):
+        distances = ((pixels[:, None, :] - centers[None, :, :]) ** 2).sum(axis=2)
+        labels = distances.argmin(axis=1)
+        counts = np.bincount(labels, minlength=k)
+        sums = np.stack([np.bincount(labels, weights=pixels[:, c], minlength=k) for c in range(3)], axis=1)
+        updated = np.where(counts[:, None] > 0, sums / np.maximum(counts, 1)[:, None], centers)
+        if np.abs(updated - centers).max() < 0.5:
+            centers = updated
+            break
+        centers = updated
+    order = np.argsort(-counts)
+    palette = []
+    for i in order:
+        if counts[i]:
+            rgb = tuple(int(round(c)) for c in centers[i])
+            palette.append({
+                "hex": "#{:02x}{:02x}{:02x}".format(*rgb),
+                "name": color_name(rgb),
+                "share": round(float(counts[i]) / len(pixels), 3)
+            })
+    return palette
+
+def image_features(path: str):
+    """Палитра, соотношение сторон и яркость фото"""
+    from PIL import Image
+    
+    with Image.open(path) as image:
+        width, height = image.size
+        image.draft("RGB", (FEATURE_SAMPLE_SIZE * 2, FEATURE_SAMPLE_SIZE * 2))
+        sample = image.convert("RGB")
+        sample.thumbnail((FEATURE_SAMPLE_SIZE, FEATURE_SAMPLE_SIZE))
+        pixels = np.asarray(sample, dtype=np.float32).reshape(-1, 3)
+    luminance = pixels @ np.array([0.299, 0.587, 0.114], dtype=np.float32) / 255
+    return {
+        "aspect_ratio": round(width / height, 3),
+        "brightness": round(float(luminance.mean()), 3),
+        "palette": kmeans_palette(pixels, PALETTE_SIZE)
+    }
+
+def extract_features_many(items):
+    """Признаки пачки постов [(text, путь к фото или None)] (выполняется в пуле процессов)"""
+    results = []
+    for text, path in items:
+        features = text_features(text)
+        if path:
+            try:
+                features.update(image_features(path))
+            except Exception:
+                pass
+        results.append(features)
+    return results
+
+class FeatureStore:
+    """Признаки постов: LRU в памяти поверх таблицы features в SQLite"""
+    def __init__(self, index: PostIndex, max_size: int):
+        self.index = index
+        self.max_size = max_size
+        self._entries = OrderedDict()  # (channel, message_id) -> features
+        self.hits = 0
+        self.misses = 0
+        self.computed = 0
+    
+    def get_many(self, keys):
+        found = {}
+        for key in keys:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                found[key] = self._entries[key]
+        missing = [key for key in keys if key not in found]
+        if missing:
+            stored = self.index.features(missing, FEATURES_VERSION)
+            self._remember(stored)
+            found.update(stored)
+        self.hits += len(found)
+        self.misses += len(keys) - len(found)
+        return found
+    
+    def put_many(self, items):
+        self.computed += len(items)
+        self.index.set_features(items, FEATURES_VERSION)
+        self._remember(items)
+    
+    def _remember(self, items):
+        for key, features in items.items():
+            self._entries[key] = features
+            self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+    
+    def stats(self):
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "computed": self.computed
+        }
+
+feature_store = FeatureStore(post_index, FEATURE_CACHE_SIZE)
+
+def parse_feed_item_id(feed_item_id: str):
+    """(channel, message_id) из id поста ленты "channel_123" или None"""
+    channel, _, message_id = feed_item_id.rpartition("_")
+    if not channel or not message_id.isdigit():
+        return None
+    return channel, int(message_id)
+
+async def load_post_rows(keys):
+    """Строки постов из индекса; недостающие подтягиваются из Telegram и сохраняются в индекс"""
+    rows = post_index.posts(keys)
+    missing = {}
+    for channel, message_id in keys:
+        if (channel, message_id) not in rows and channel in CHANNEL_CATEGORIES:
+            missing.setdefault(channel, []).append(message_id)
+    if not missing or not telegram_client.connected:
+        return rows
+    
+    for channel, ids in missing.items():
+        try:
+            entity = await telegram_client.resolve_entity(channel)
+            messages = await rpc_scheduler.call(
+                "get_messages", lambda: telegram_client.client.get_messages(entity, ids=ids), INTERACTIVE
             )
+            post_index.upsert([message_row(channel, message) for message in messages if message])
+        except Exception as e:
+            logger.error(f"❌ Error loading posts from {channel}: {e}")
+    return post_index.posts(keys)
+
+async def post_features(feed_item_ids, texts=None):
+    """Признаки постов по id ленты: {feed_item_id: features}, ошибки - {feed_item_id: причина}
+    
+    Посчитанные признаки берутся из FeatureStore; для остальных фото
+    подтягиваются через кэш фото, а извлечение идет одной пачкой в пуле процессов.
+    Постов, которых нет в индексе (демо, Telegram недоступен), хватает на
+    признаки по подписи из texts - без палитры и не кэшируются.
+    """
+    texts = texts or {}
+    keys = {}
+    errors = {}
+    for feed_item_id in feed_item_ids:
+        key = parse_feed_item_id(feed_item_id)
+        if key is None:
+            errors[feed_item_id] = "invalid feed item id"
         else:
-            raise HTTPException(500, f"Error getting photo: {str(e)}")
+            keys[feed_item_id] = key
+    
+    known = feature_store.get_many(list(set(keys.values())))
+    missing = [key for key in dict.fromkeys(keys.values()) if key not in known]
+    if missing:
+        rows = await load_post_rows(missing)
+        missing = [key for key in missing if key in rows]
+        photos = await asyncio.gather(*(
+            cached_photo(*key, FEATURE_PHOTO_WIDTH, FEATURE_PHOTO_FORMAT) if rows[key]['has_photo'] else asyncio.sleep(0)
+            for key in missing
+        ))
+        extracted = await asyncio.get_running_loop().run_in_executor(
+            image_pool(), extract_features_many,
+            [(rows[key]['text'], photo[0] if photo else None) for key, photo in zip(missing, photos)]
+        )
+        computed = {key: features for key, features in zip(missing, extracted)}
+        # Без фото (Telegram недоступен) признаки неполные - не кэшируем, посчитаем в следующий раз
+        feature_store.put_many({
+            key: features for key, features in computed.items()
+            if 'palette' in features or not rows[key]['has_photo']
+        })
+        known.update(computed)
+    
+    features = {}
+    for feed_item_id, key in keys.items():
+        features[feed_item_id] = known[key] if key in known else text_features(texts.get(feed_item_id, ""))
+    return features, errors
+
+def build_prompts(features, category: str):
+    """Промпты из признаков поста: палитра, формат кадра, яркость, ключевые слова и хэштеги"""
+    category = category or "lifestyle"
+    colors = ", ".join(dict.fromkeys(color["name"] for color in features.get("palette", [])[:3])) or "natural"
+    subject = ", ".join(features["keywords"][:3]) or f"{category} product"
+    hashtags = " ".join(f"#{tag}" for tag in features["hashtags"][:3])
+    
+    aspect_ratio = features.get("aspect_ratio", 0.8)
+    if aspect_ratio < 0.9:
+        frame = "vertical 4:5 frame"
+    elif aspect_ratio > 1.1:
+        frame = "horizontal 16:9 frame"
+    else:
+        frame = "square frame"
+    brightness = features.get("brightness", 0.5)
+    mood = "bright airy" if brightness > 0.62 else "dark moody" if brightness < 0.38 else "soft natural"
+    
+    prompts = [
+        f"{category.capitalize()} editorial photo of {subject}, {colors} palette, {mood} lighting, {frame}",
+        f"Product shot featuring {subject} in {colors} tones, {mood} mood, clean background, {frame}",
+        f"Social media creative about {subject}, {colors} color story, {frame}" + (f", {hashtags}" if hashtags else "")
+    ]
+    return prompts
+
+def category_of(feed_item_id: str):
+    key = parse_feed_item_id(feed_item_id)
+    # Демо-посты имеют id вида "channel_demo_1"
+    return CHANNEL_CATEGORIES.get(key[0].removesuffix("_demo"), "") if key else ""
+
+async def generate_prompts_batch(feed_item_ids, texts=None):
+    features, errors = await post_features(feed_item_ids, texts)
+    items = []
+    for feed_item_id in feed_item_ids:
+        if feed_item_id in errors:
+            items.append({"feed_item_id": feed_item_id, "error": errors[feed_item_id]})
+            continue
+        items.append({
+            "feed_item_id": feed_item_id,
+            "prompts": build_prompts(features[feed_item_id], category_of(feed_item_id)),
+            "features": features[feed_item_id],
+            "seed": random.randint(1000, 9999)
+        })
+    return items
 
 @app.post("/prompts/generate")
 async def gen_prompts(req: PromptReq):
-    """Генерация промптов"""
+    """Генерация промптов по признакам поста"""
     logger.info(f"🎨 Generating prompts for: {req.feed_item_id}")
     
+    item = (await generate_prompts_batch([req.feed_item_id], {req.feed_item_id: req.text}))[0]
+    if "error" in item:
+        raise HTTPException(404, item["error"])
     return {
-        "prompts": [
-            f"Create a stunning fashion image inspired by {req.feed_item_id}",
-            f"Generate beautiful content based on {req.feed_item_id}",
-            f"Design an elegant concept for {req.feed_item_id}"
-        ],
-        "seed": random.randint(1000, 9999),
+        "prompts": item["prompts"],
+        "features": item["features"],
+        "seed": item["seed"],
         "provider": "telegram_real"
     }
 
+@app.post("/prompts/generate/batch")
+async def gen_prompts_batch(req: PromptBatchReq):
+    """Промпты для пачки постов (например, всей страницы ленты) за один запрос"""
+    logger.info(f"🎨 Generating prompts for {len(req.feed_item_ids)} posts")
+    return {"items": await generate_prompts_batch(req.feed_item_ids, req.texts), "provider": "telegram_real"}
+
+def creative_item(item):
+    if "error" in item:
+        return item
+    return {
+        "feed_item_id": item["feed_item_id"],
+        "image_url": "https://images.unsplash.com/photo-1441986300917-64674bd600d8?w=400&h=600&fit=crop",
+        "prompt": item["prompts"][0],
+        "seed": item["seed"]
+    }
+
 @app.post("/creative/generate")
 async def creative_generate(req: PromptReq):
     """Генерация изображений"""
     logger.info(f"🎨 Generating image for: {req.feed_item_id}")
     
+    item = (await generate_prompts_batch([req.feed_item_id], {req.feed_item_id: req.text}))[0]
+    if "error" in item:
+        raise HTTPException(404, item["error"])
+    creative = creative_item(item)
     return {
-        "image_url": "https://images.unsplash.com/photo-1441986300917-64674bd600d8?w=400&h=600&fit=crop",
-        "prompt": f"Generated image for {req.feed_item_id}",
-        "seed": random.randint(1000, 9999),
+        "image_url": creative["image_url"],
+        "prompt": creative["prompt"],
+        "seed": creative["seed"],
         "provider": "telegram_real"
     }
 
+@app.post("/creative/generate/batch")
+async def creative_generate_batch(req: PromptBatchReq):
+    """Генерация изображений для пачки постов за один запрос"""
+    logger.info(f"🎨 Generating images for {len(req.feed_item_ids)} posts")
+    items = await generate_prompts_batch(req.feed_item_ids, req.texts)
+    return {"items": [creative_item(item) for item in items], "provider": "telegram_real"}
+
 @app.get("/ui", response_class=HTMLResponse)
 def ui():
     """Главная страница с UI"""
@@ -332,20 +3003,57 @@ def ui():
     </div>
 
     <script>
+        let feedSource = null;
+        let feedRequest = 0;
+        const FEED_LIMIT = 25;
+        
         async function loadFeed(category) {
-            // Обновляем активную вкладку
-            document.querySelectorAll('.tab').forEach(tab => tab.classList.remove('active'));
-            event.target.classList.add('active');
+            // Обновляем активную вкладку (при первой загрузке клика нет - активна fashion из разметки)
+            if (window.event) {
+                document.querySelectorAll('.tab').forEach(tab => tab.classList.remove('active'));
+                window.event.target.classList.add('active');
+            }
+            const request = ++feedRequest;
+            // События старой категории не должны попадать в новую сетку, пока она грузится или при ошибке
+            if (feedSource) {
+                feedSource.close();
+                feedSource = null;
+            }
             
             // Показываем загрузку
             document.getElementById('feed').innerHTML = '<div class="loading">Loading real posts from Telegram...</div>';
             
             try {
-                const response = await fetch(`/telegram/channels/${category}`);
-                const data = await response.json();
+                // NDJSON-поток: посты каждого канала показываем сразу, как только канал ответил
+                const response = await fetch(`/telegram/channels/${category}?stream=1&limit=${FEED_LIMIT}`);
+                const reader = response.body.getReader();
+                const decoder = new TextDecoder();
+                let buffer = '';
+                let posts = [];
+                
+                while (true) {
+                    const { done, value } = await reader.read();
+                    if (request !== feedRequest) {
+                        // Загрузку перехватил более новый запрос - закрываем поток, а не дочитываем его
+                        await reader.cancel();
+                        return;
+                    }
+                    if (done) break;
+                    buffer += decoder.decode(value, { stream: true });
+                    const lines = buffer.split('\n');
+                    buffer = lines.pop();
+                    for (const line of lines) {
+                        const message = line ? JSON.parse(line) : {};
+                        if (message.posts && message.posts.length) {
+                            posts = mergePosts(posts, message.posts).slice(0, FEED_LIMIT);
+                            displayPosts(posts);
+                        }
+                    }
+                }
                 
-                if (data.posts) {
-                    displayPosts(data.posts);
+                if (request !== feedRequest) return;
+                if (posts.length) {
+                    subscribeFeed(category);
                 } else {
                     document.getElementById('feed').innerHTML = '<div class="loading">No posts found</div>';
                 }
@@ -355,11 +3063,48 @@ def ui():
             }
         }
         
+        // Слияние двух отсортированных списков в порядке ленты: score по убыванию, затем id
+        function mergePosts(left, right) {
+            const merged = [];
+            let i = 0, j = 0;
+            while (i < left.length && j < right.length) {
+                const a = left[i], b = right[j];
+                if (a.score > b.score || (a.score === b.score && a.id < b.id)) {
+                    merged.push(left[i++]);
+                } else {
+                    merged.push(right[j++]);
+                }
+            }
+            return merged.concat(left.slice(i), right.slice(j));
+        }
+        
+        // Карточки показывают фото высотой 300px - оригинал в полном размере не нужен
+        function photoUrl(url) {
+            return url.startsWith('/photo/') ? `${url}?w=400&fmt=webp` : url;
+        }
+        
+        // Новые и обновленные посты приходят по SSE и вставляются в сетку без перезагрузки категории
+        function subscribeFeed(category) {
+            feedSource = new EventSource(`/events/${category}`);
+            feedSource.addEventListener('post', (e) => {
+                const post = JSON.parse(e.data);
+                const existing = document.querySelector(`.post[data-id="${post.id}"]`);
+                if (existing) {
+                    existing.outerHTML = renderPost(post);
+                } else {
+                    document.getElementById('feed').insertAdjacentHTML('afterbegin', renderPost(post));
+                }
+            });
+        }
+        
         function displayPosts(posts) {
-            const feed = document.getElementById('feed');
-            feed.innerHTML = posts.map(post => `
-                <div class="post">
-                    <img src="${post.media_url}" alt="${post.text}" loading="lazy">
+            document.getElementById('feed').innerHTML = posts.map(renderPost).join('');
+        }
+        
+        function renderPost(post) {
+            return `
+                <div class="post" data-id="${post.id}">
+                    <img src="${photoUrl(post.media_url)}" alt="${post.text}" loading="lazy">
                     <div class="post-content">
                         <p>${post.text}</p>
                         <div class="post-stats">
@@ -371,18 +3116,37 @@ def ui():
                         <button class="btn btn-secondary" onclick="generateImage('${post.id}')">Сгенерировать</button>
                     </div>
                 </div>
-            `).join('');
+            `;
+        }
+        
+        // Промпты запрашиваются сразу для всех постов на экране одним batch-запросом и кэшируются
+        const promptCache = {};
+        
+        // Подпись карточки: сервер строит по ней промпты, если поста нет в индексе (демо-режим)
+        function postText(feedItemId) {
+            const post = document.querySelector(`.post[data-id="${feedItemId}"] .post-content p`);
+            return post ? post.textContent : '';
         }
         
         async function generatePrompt(feedItemId) {
             try {
-                const response = await fetch('/prompts/generate', {
-                    method: 'POST',
-                    headers: { 'Content-Type': 'application/json' },
-                    body: JSON.stringify({ feed_item_id: feedItemId })
-                });
-                const data = await response.json();
-                alert('Generated prompts: ' + data.prompts.join(', '));
+                if (!promptCache[feedItemId]) {
+                    const ids = [...document.querySelectorAll('.post[data-id]')]
+                        .map(post => post.dataset.id)
+                        .filter(id => !promptCache[id])
+                        .slice(0, 100);
+                    if (!ids.includes(feedItemId)) ids[ids.length ? ids.length - 1 : 0] = feedItemId;
+                    const texts = Object.fromEntries(ids.map(id => [id, postText(id)]));
+                    const response = await fetch('/prompts/generate/batch', {
+                        method: 'POST',
+                        headers: { 'Content-Type': 'application/json' },
+                        body: JSON.stringify({ feed_item_ids: ids, texts })
+                    });
+                    const data = await response.json();
+                    data.items.forEach(item => { promptCache[item.feed_item_id] = item; });
+                }
+                const item = promptCache[feedItemId];
+                alert(item.error ? 'No prompts: ' + item.error : 'Generated prompts: ' + item.prompts.join(', '));
             } catch (error) {
                 console.error('Error generating prompt:', error);
                 alert('Error generating prompt');
@@ -394,7 +3158,7 @@ def ui():
                 const response = await fetch('/creative/generate', {
                     method: 'POST',
                     headers: { 'Content-Type': 'application/json' },
-                    body: JSON.stringify({ feed_item_id: feedItemId })
+                    body: JSON.stringify({ feed_item_id: feedItemId, text: postText(feedItemId) })
                 });
                 const data = await response.json();
                 window.open(data.image_url, '_blank');
@@ -412,4 +3176,21 @@ def ui():
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    if WEB_WORKERS > 1:
+        import subprocess
+        import sys
+        
+        # Один фетчер держит сессию Telegram, N воркеров обслуживают HTTP на всех ядрах
+        fetcher = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "main:app", "--uds", FETCHER_SOCKET],
+            env={**os.environ, "APP_ROLE": "fetcher"},
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        )
+        os.environ["APP_ROLE"] = "web"
+        try:
+            uvicorn.run("main:app", host="0.0.0.0", port=PORT, workers=WEB_WORKERS)
+        finally:
+            fetcher.terminate()
+            fetcher.wait()
+    else:
+        uvicorn.run(app, host="0.0.0.0", port=PORT)
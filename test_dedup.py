@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+"""
+Офлайн-тесты поиска почти одинаковых фото: MultiIndexHash против полного перебора
+"""
+import random
+
+import main
+
+
+def flip_bits(key: int, count: int, rnd):
+    for bit in rnd.sample(range(64), count):
+        key ^= 1 << bit
+    return key
+
+
+def test_search_finds_neighbours_within_radius():
+    rnd = random.Random(7)
+    index = main.MultiIndexHash(radius=6)
+    key = rnd.getrandbits(64)
+    index.add(key, "origin")
+
+    for distance in range(7):
+        assert index.search(flip_bits(key, distance, rnd)) == [(distance, "origin")]
+    assert index.search(flip_bits(key, 7, rnd)) == []
+
+
+def test_search_matches_brute_force():
+    rnd = random.Random(11)
+    index = main.MultiIndexHash(radius=6)
+    keys = [rnd.getrandbits(64) for _ in range(2000)]
+    for i, key in enumerate(keys):
+        index.add(key, i)
+
+    for _ in range(300):
+        query = flip_bits(rnd.choice(keys), rnd.randint(0, 10), rnd)
+        expected = sorted((bin(query ^ key).count("1"), i) for i, key in enumerate(keys)
+                          if bin(query ^ key).count("1") <= 6)
+        assert sorted(index.search(query)) == expected
+
+
+def test_duplicate_key_keeps_first_value():
+    index = main.MultiIndexHash(radius=2)
+    index.add(0b1011, "first")
+    index.add(0b1011, "second")
+    assert len(index) == 1
+    assert index.search(0b1011) == [(0, "first")]
@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+"""
+Офлайн-тесты фоновой загрузки: догоняние разрыва, если новых сообщений больше лимита
+"""
+import asyncio
+
+import main
+
+
+def indexed_ids(channel: str):
+    rows = main.post_index.db.execute("SELECT message_id FROM posts WHERE channel = ?", (channel,))
+    return sorted(row['message_id'] for row in rows)
+
+
+def test_ingest_catches_up_oldest_first(fake_telegram, monkeypatch):
+    channel = "catchup_channel"
+    fake_telegram.messages_per_channel = 50
+    monkeypatch.setattr(main, "INGEST_MAX_MESSAGES", 100)
+    planner = main.ingester.planner
+
+    async def scenario():
+        # Первая загрузка берет последние сообщения канала
+        await main.ingester.ingest_new(channel)
+        assert indexed_ids(channel) == list(range(1, 51))
+
+        # Пока ингестер стоял, в канале вышло 250 сообщений - больше лимита одного опроса
+        for _ in range(250):
+            await fake_telegram.emit_message(channel)
+
+        progress = []
+        for _ in range(3):
+            await main.ingester.ingest_new(channel)
+            progress.append((main.post_index.channel_state(channel)['max_id'], channel in planner.behind))
+        return progress
+
+    progress = asyncio.run(scenario())
+    # Каждый опрос продолжает с места предыдущего, пока не догонит
+    assert progress == [(150, True), (250, True), (300, False)]
+    assert indexed_ids(channel) == list(range(1, 301))
+
+
+def test_channel_behind_is_polled_sooner(fake_telegram, monkeypatch):
+    channel = "behind_channel"
+    monkeypatch.setitem(main.CHANNEL_CATEGORIES, channel, "fashion")
+    planner = main.ingester.planner
+    # Редкий канал: по частоте постов его опрашивали бы раз в несколько часов
+    main.post_index.mark_polled(channel, 1, post_rate=0.1)
+
+    def poll_due():
+        return next(due for due, kind, ch in planner.plan() if kind == "poll" and ch == channel)
+
+    relaxed = poll_due()
+    monkeypatch.setattr(planner, "behind", {channel})
+    assert poll_due() < relaxed
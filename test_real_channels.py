@@ -10,7 +10,7 @@ from dotenv import load_dotenv
 
 load_dotenv()
 
-async def test_real_channels():
+async def check_real_channels():
     """Тестируем реальные каналы"""
     
     # Получаем credentials
@@ -86,5 +86,13 @@ async def test_real_channels():
     finally:
         await client.disconnect()
 
+def test_real_channels():
+    """Запуск под pytest: без credentials Telegram тест пропускается"""
+    import pytest
+    
+    if not all([os.getenv("TELEGRAM_API_ID"), os.getenv("TELEGRAM_API_HASH"), os.getenv("TELEGRAM_SESSION")]):
+        pytest.skip("Telegram credentials are not configured")
+    asyncio.run(check_real_channels())
+
 if __name__ == "__main__":
-    asyncio.run(test_real_channels())
+    asyncio.run(check_real_channels())
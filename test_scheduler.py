@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""
+Офлайн-тесты очереди RPC: token bucket и паузы методов после FloodWait
+"""
+import asyncio
+import time
+
+import pytest
+from telethon.errors import FloodWaitError
+
+import main
+
+
+def test_token_bucket_allows_burst_then_paces():
+    bucket = main.TokenBucket(rate=10, burst=2)
+    for _ in range(2):
+        assert bucket.delay() == 0
+        bucket.take()
+    assert bucket.delay() == pytest.approx(0.1, abs=0.02)
+
+
+def test_short_flood_wait_pauses_only_its_method(monkeypatch):
+    monkeypatch.setattr(main, "FLOOD_WAIT_RETRY_MAX", 30)
+    scheduler = main.RpcScheduler({"flooded": (100, 10), "other": (100, 10)})
+    attempts = []
+
+    async def flooded():
+        attempts.append(time.monotonic())
+        if len(attempts) == 1:
+            raise FloodWaitError(None, capture=1)
+        return "ok"
+
+    async def other():
+        return time.monotonic()
+
+    async def scenario():
+        started = time.monotonic()
+        flooded_call = asyncio.create_task(scheduler.call("flooded", flooded))
+        await asyncio.sleep(0.05)
+        other_done = await scheduler.call("other", other)
+        return started, await flooded_call, other_done
+
+    started, result, other_done = asyncio.run(scenario())
+    assert result == "ok"
+    # Повтор - только после паузы, а соседний метод ее не ждет
+    assert attempts[1] - attempts[0] >= 0.95
+    assert other_done - started < 0.5
+    assert scheduler.flood_waits["flooded"] == 1
+
+
+def test_long_flood_wait_fails_fast(monkeypatch):
+    monkeypatch.setattr(main, "FLOOD_WAIT_RETRY_MAX", 30)
+    scheduler = main.RpcScheduler({"flooded": (1, 1)})
+
+    async def flood():
+        raise FloodWaitError(None, capture=3600)
+
+    async def ok():
+        return "ok"
+
+    async def scenario():
+        with pytest.raises(FloodWaitError):
+            await scheduler.call("flooded", flood)
+        started = time.monotonic()
+        with pytest.raises(FloodWaitError) as error:
+            await scheduler.call("flooded", ok)
+        return time.monotonic() - started, error.value.seconds
+
+    elapsed, seconds = asyncio.run(scenario())
+    assert elapsed < 0.1
+    assert seconds > 3500
+
+
+def test_queued_callers_are_released_by_long_flood_wait(monkeypatch):
+    monkeypatch.setattr(main, "FLOOD_WAIT_RETRY_MAX", 30)
+    # Один токен в секунду: остальные вызовы стоят в очереди за первым
+    scheduler = main.RpcScheduler({"flooded": (1, 1)})
+
+    async def flood():
+        raise FloodWaitError(None, capture=3600)
+
+    async def ok():
+        return "ok"
+
+    async def scenario():
+        first = asyncio.create_task(scheduler.call("flooded", flood))
+        await asyncio.sleep(0)
+        queued = [asyncio.create_task(scheduler.call("flooded", ok)) for _ in range(5)]
+        started = time.monotonic()
+        results = await asyncio.wait_for(asyncio.gather(first, *queued, return_exceptions=True), 5)
+        return time.monotonic() - started, results
+
+    elapsed, results = asyncio.run(scenario())
+    assert all(isinstance(result, FloodWaitError) for result in results)
+    assert elapsed < 2